@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+
+"""
+benchmark encode throughput and size accuracy of webm.py
+
+Synthetic inputs are generated with FFmpeg's lavfi sources, encoded with
+every combination of codec, speed and size limit and the measurements
+are written as JSON baseline which can be compared with the later runs.
+
+examples:
+  - record baseline:       python bench.py -o base.json
+  - compare with baseline: python bench.py -o new.json --compare base.json
+  - only VP9, quick:       python bench.py -c vp9 --quick
+  - extra webm.py options: python bench.py -- -fo='-row-mt 0'
+  - check tile planner:    python bench.py --tiles -l 0
+"""
+
+from __future__ import division  # Install Python 2.7+ or 3.2+
+from __future__ import print_function  # Install Python 2.7+ or 3.2+
+from __future__ import unicode_literals  # Install Python 2.7+ or 3.2+
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+
+import webm
+
+
+# name, lavfi video source, width, height, fps, duration
+INPUTS = [
+    ('testsrc2-240p', 'testsrc2', 320, 240, 24, 10),
+    ('testsrc2-720p', 'testsrc2', 1280, 720, 30, 10),
+    ('mandelbrot-360p', 'mandelbrot', 640, 360, 25, 10),
+    ('noise-360p', 'noise', 640, 360, 25, 10),
+]
+QUICK_INPUTS = ['testsrc2-240p', 'noise-360p']
+CODECS = {
+    'vp9': [],
+    'vp8': ['-vp8'],
+    'av1': ['-av1'],
+}
+SPEEDS = {
+    'vp9': [1, 4],
+    'vp8': [0, 4],
+    'av1': [4, 8],
+}
+# Size limits in mebibytes, None is the default constrained quality.
+LIMITS = [None, 0.5, 2]
+QUICK_LIMITS = [0.5]
+# Fixed tilings compared with the planner by --tiles: log2 tile
+# columns and rows, token partitions for VP8. They use all CPUs.
+TILE_VARIANTS = {
+    'vp9': [(0, 0), (1, 0), (2, 0), (3, 0)],
+    'vp8': [1, 2, 4, 8],
+    'av1': [(0, 0), (1, 0), (2, 0), (1, 1), (2, 1)],
+}
+
+
+def _get_parser():
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '-o', dest='output', metavar='baseline',
+        help='write results to the given JSON file')
+    parser.add_argument(
+        '--compare', metavar='baseline',
+        help='compare results with previously saved JSON file')
+    parser.add_argument(
+        '--threshold', metavar='percent', type=float, default=10,
+        help='slowdown or size error change treated as regression\n'
+             '(default: %(default)s)')
+    parser.add_argument(
+        '-c', dest='codecs', metavar='codec', action='append',
+        choices=sorted(CODECS),
+        help='codec to benchmark, may be repeated (default: all)')
+    parser.add_argument(
+        '-s', dest='speeds', metavar='speed', type=int, action='append',
+        help='speed to benchmark, may be repeated\n'
+             '(default: few typical values for each codec)')
+    parser.add_argument(
+        '-l', dest='limits', metavar='limit', type=float, action='append',
+        help='size limit to benchmark, may be repeated; 0 means no limit')
+    parser.add_argument(
+        '-f', dest='filter', metavar='substring',
+        help='run only the cases which name contains substring')
+    parser.add_argument(
+        '--tiles', action='store_true',
+        help='also run every case with fixed tilings and all CPU\n'
+             'threads to validate choices of the tile planner')
+    parser.add_argument(
+        '--quick', action='store_true',
+        help='use only the small inputs and single limit')
+    parser.add_argument(
+        '--workdir', metavar='dir',
+        help='where to keep generated inputs (default: system temp)')
+    parser.add_argument(
+        'extra', nargs='*',
+        help='additional webm.py options, pass them after --')
+    return parser
+
+
+def _make_input(workdir, spec):
+    name, source, width, height, fps, duration = spec
+    path = os.path.join(workdir, name + '.mkv')
+    if os.path.exists(path):
+        return path
+    size = '{}x{}'.format(width, height)
+    if source == 'noise':
+        video = 'color=c=gray:s={}:r={},noise=alls=60:allf=t'.format(
+            size, fps)
+    else:
+        video = '{}=s={}:r={}'.format(source, size, fps)
+    tmppath = path + '.tmp.mkv'
+    # Lossless intermediate so every run reads exactly the same frames.
+    subprocess.check_call([
+        webm.FFMPEG_PATH, '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', video,
+        '-f', 'lavfi', '-i', 'sine=f=440:b=4:r=48000',
+        '-t', str(duration),
+        '-c:v', 'ffv1', '-pix_fmt', 'yuv420p', '-c:a', 'flac',
+        tmppath,
+    ])
+    os.rename(tmppath, path)
+    return path
+
+
+def _run(args, env):
+    """
+    Run command and return wall time with resource usage of it and all
+    its children.
+    """
+    start = time.time()
+    log = tempfile.TemporaryFile()
+    p = subprocess.Popen(args, env=env, stderr=log)
+    if hasattr(os, 'wait4'):
+        _, status, usage = os.wait4(p.pid, 0)
+        p.returncode = os.WEXITSTATUS(status) \
+            if os.WIFEXITED(status) else -1
+    else:
+        p.wait()
+        usage = None
+    wall = time.time() - start
+    if p.returncode != 0:
+        log.seek(0)
+        raise Exception('command failed: {}\n{}'.format(
+            ' '.join(args), log.read().decode('utf-8', 'ignore')))
+    log.close()
+    if usage is None:
+        return wall, None, None
+    cpu = usage.ru_utime + usage.ru_stime
+    # Kilobytes on Linux, bytes on macOS.
+    maxrss = usage.ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss //= 1024
+    return wall, cpu, maxrss
+
+
+def _get_cases(options):
+    inputs = INPUTS
+    if options.quick:
+        inputs = [spec for spec in INPUTS if spec[0] in QUICK_INPUTS]
+    limits = LIMITS
+    if options.limits:
+        limits = [limit or None for limit in options.limits]
+    elif options.quick:
+        limits = QUICK_LIMITS
+    cases = []
+    for spec in inputs:
+        for codec in options.codecs or sorted(CODECS):
+            for speed in options.speeds or SPEEDS[codec]:
+                for limit in limits:
+                    name = '{}/{}/s{}/{}'.format(
+                        spec[0], codec, speed,
+                        'crf' if limit is None else 'l{:g}'.format(limit))
+                    if options.filter and options.filter not in name:
+                        continue
+                    variants = [None]
+                    if options.tiles:
+                        variants += TILE_VARIANTS[codec]
+                    for variant in variants:
+                        cases.append((name, spec, codec, speed, limit,
+                                      variant))
+    return cases
+
+
+def _format_variant(variant):
+    if variant is None:
+        return 'auto'
+    if isinstance(variant, int):
+        return 'p{}'.format(variant)
+    return 'c{}r{}'.format(*variant)
+
+
+def _get_tile_args(variant, cpus):
+    if variant is None:
+        return []
+    if isinstance(variant, int):
+        fo = '-slices {} -threads {}'.format(variant, cpus)
+    else:
+        fo = '-tile-columns {} -tile-rows {} -threads {}'.format(
+            variant[0], variant[1], cpus)
+    return ['-fo=' + fo]
+
+
+def _get_script():
+    return os.path.splitext(os.path.abspath(webm.__file__))[0] + '.py'
+
+
+def _get_plan(options, caps, codec, spec, cpus):
+    """
+    Planned tiling of the case, with the same capabilities and encoder
+    as webm.py uses.
+    """
+    row_mt = caps['row_mt']
+    tile_rows = True
+    if codec == 'av1':
+        name = None
+        for i, arg in enumerate(options.extra):
+            if arg == '-av1enc' and i + 1 < len(options.extra):
+                name = options.extra[i + 1]
+            elif arg.startswith('-av1enc='):
+                name = arg.split('=', 1)[1]
+        if webm._get_av1_encoder(name, caps) == 'libaom-av1':
+            row_mt = caps['aom_row_mt']
+            tile_rows = caps['aom_tile_rows']
+        else:
+            row_mt = False
+    return webm.plan_tiles(codec, spec[2], spec[3], cpus, row_mt,
+                           tile_rows=tile_rows)
+
+
+def run_case(options, caps, workdir, env, case):
+    name, spec, codec, speed, limit, variant = case
+    cpus = webm.get_cpu_budget()[0]
+    if options.tiles:
+        name += '/' + _format_variant(variant)
+    infile = _make_input(workdir, spec)
+    outfile = os.path.join(workdir, 'out.webm')
+    args = [sys.executable, _get_script(), '-q', '--no-passlog-cache',
+            '--no-size-stats', '-i', infile, '-speed', str(speed)]
+    args += CODECS[codec]
+    if limit is not None:
+        args += ['-l', str(limit)]
+    args += options.extra + _get_tile_args(variant, cpus) + [outfile]
+    wall, cpu, maxrss = _run(args, env)
+    size = os.path.getsize(outfile)
+    os.remove(outfile)
+    frames = spec[4] * spec[5]
+    result = {
+        'name': name,
+        'input': spec[0],
+        'codec': codec,
+        'speed': speed,
+        'limit': limit,
+        'tiles': _format_variant(variant),
+        'plan': _get_plan(options, caps, codec, spec, cpus),
+        'wall': wall,
+        'cpu': cpu,
+        'maxrss': maxrss,
+        'fps': frames / wall,
+        'size': size,
+        'size_error': None,
+    }
+    if limit is not None:
+        limit = limit * 1024 * 1024
+        result['size_error'] = (size - limit) / limit * 100
+    return result
+
+
+def print_tile_summary(results):
+    """
+    Print the fastest tiling of every case next to the planned one.
+    """
+    groups = {}
+    for result in results:
+        groups.setdefault(result['name'].rsplit('/', 1)[0], []).append(result)
+    print('='*50, file=sys.stderr)
+    for name, group in sorted(groups.items()):
+        auto = [r for r in group if r['tiles'] == 'auto'][0]
+        best = max(group, key=lambda r: r['fps'])
+        plan = auto['plan']
+        print('{:<36} auto ({}) {:.1f} fps, best {} {:.1f} fps{}'.format(
+                  name,
+                  'p{slices}t{threads}'.format(**plan)
+                  if plan['slices'] is not None else
+                  'c{tile_columns}r{tile_rows}t{threads}'.format(**plan),
+                  auto['fps'], best['tiles'], best['fps'],
+                  '' if best is auto else ' ({:+.1f}%)'.format(
+                      (auto['fps'] - best['fps']) / best['fps'] * 100)),
+              file=sys.stderr)
+
+
+def _fmt(value, fmt):
+    return '-' if value is None else fmt.format(value)
+
+
+def print_result(result):
+    print('{:<36} {:>7}s {:>7}s {:>8} {:>6} {:>9} {:>7}'.format(
+              result['name'],
+              _fmt(result['wall'], '{:.1f}'),
+              _fmt(result['cpu'], '{:.1f}'),
+              _fmt(result['maxrss'], '{}K'),
+              _fmt(result['fps'], '{:.1f}'),
+              result['size'],
+              _fmt(result['size_error'], '{:+.1f}%')),
+          file=sys.stderr)
+
+
+def compare(old, new, threshold):
+    """
+    Print differences between two baselines. Return number of
+    regressions: CPU or wall time slower than threshold or size error
+    further from the limit by more than threshold percents.
+    """
+    base = dict((result['name'], result) for result in old['results'])
+    regressions = 0
+    print('='*50, file=sys.stderr)
+    print('Compared with {} (webm.py {}, FFmpeg {})'.format(
+              old['date'], old['version'], old['ffmpegv']),
+          file=sys.stderr)
+    for result in new['results']:
+        prev = base.get(result['name'])
+        if prev is None:
+            continue
+        notes = []
+        for key in ['wall', 'cpu']:
+            if result[key] is None or not prev[key]:
+                continue
+            change = (result[key] - prev[key]) / prev[key] * 100
+            notes.append('{} {:+.1f}%'.format(key, change))
+            if change > threshold:
+                notes[-1] += ' (SLOWER)'
+                regressions += 1
+        change = (result['size'] - prev['size']) / prev['size'] * 100
+        notes.append('size {:+.1f}%'.format(change))
+        if result['size_error'] is not None and \
+                prev['size_error'] is not None:
+            # Overweight is always a regression, underweight only if it
+            # grew noticeably.
+            error, preverror = result['size_error'], prev['size_error']
+            if (error > 0 and preverror <= 0) or \
+                    abs(error) - abs(preverror) > threshold:
+                notes.append('size error {:+.1f}% -> {:+.1f}% (WORSE)'.format(
+                    preverror, error))
+                regressions += 1
+        print('{:<36} {}'.format(result['name'], ', '.join(notes)),
+              file=sys.stderr)
+    print('Regressions: {}'.format(regressions), file=sys.stderr)
+    return regressions
+
+
+def main():
+    options = _get_parser().parse_args()
+    workdir = options.workdir or os.path.join(
+        tempfile.gettempdir(), 'webm-bench')
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    # Don't let caches of the previous runs skew the results.
+    env = dict(os.environ)
+    env['WEBM_CACHE_DIR'] = tempfile.mkdtemp(dir=workdir)
+    # Probe capabilities once so the first case doesn't pay for it.
+    webm.CACHE_DIR = env['WEBM_CACHE_DIR']
+    caps = webm.get_capabilities([])
+    report = {
+        'version': webm.__version__,
+        'ffmpegv': caps['ffmpegv'],
+        'pythonv': caps['pythonv'],
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'extra': options.extra,
+        'results': [],
+    }
+    cases = _get_cases(options)
+    if not cases:
+        sys.exit('No cases to run')
+    print('{:<36} {:>8} {:>8} {:>8} {:>6} {:>9} {:>7}'.format(
+              'case', 'wall', 'cpu', 'maxrss', 'fps', 'size', 'error'),
+          file=sys.stderr)
+    try:
+        for case in cases:
+            result = run_case(options, caps, workdir, env, case)
+            print_result(result)
+            report['results'].append(result)
+    finally:
+        shutil.rmtree(env['WEBM_CACHE_DIR'])
+    if options.tiles:
+        print_tile_summary(report['results'])
+
+    if options.output is not None:
+        with open(options.output, 'w') as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+    if options.compare is not None:
+        with open(options.compare) as fh:
+            old = json.load(fh)
+        if compare(old, report, options.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
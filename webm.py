@@ -26,7 +26,8 @@ examples:
 use custom location of FFmpeg executable:
   - *nix:    WEBM_FFMPEG=/opt/ffmpeg/ffmpeg {stitle} -i in.mkv
   - Windows: set WEBM_FFMPEG=C:\\ffmpeg.exe & {stitle} -i in.mkv
-similarly you can set custom location of mpv executable with WEBM_MPV
+similarly you can set custom location of mpv executable with WEBM_MPV,
+ffprobe executable with WEBM_FFPROBE and cache directory with WEBM_CACHE_DIR
 """
 
 # Since there is no way to wrap future imports in try/except, we use
@@ -39,12 +40,16 @@ from __future__ import unicode_literals  # Install Python 2.7+ or 3.2+
 import os
 import re
 import sys
+import copy
 import json
 import math
 import time
 import shlex
 import locale
+import shutil
+import hashlib
 import tempfile
+import threading
 import traceback
 import subprocess
 
@@ -63,6 +68,109 @@ _input = raw_input if _PY2 else input  # noqa: F821
 _range = xrange if _PY2 else range  # noqa: F821
 
 
+class WebmError(Exception):
+    """Base class of the errors raised by webm.py."""
+
+
+class OptionsError(WebmError):
+    """Invalid value or combination of the options."""
+
+
+class DependencyError(WebmError):
+    """FFmpeg/mpv is missing, too old or lacks the required encoder."""
+
+
+class FFmpegError(WebmError):
+    """FFmpeg or ffprobe failed to run or exited with error."""
+
+
+class BatchError(WebmError):
+    """Some of the batch jobs failed, ``failed`` holds their results."""
+
+    def __init__(self, message, failed):
+        WebmError.__init__(self, message)
+        self.failed = failed
+
+
+# Chunks shorter than that don't benefit from 2-pass rate control.
+_CHUNK_MIN_DURATION = 5
+# Least recently used first pass logs are removed above that size.
+_PASSLOG_CACHE_SIZE = 256 * 1024 * 1024
+# Same for the memoized content hashes.
+_HASH_CACHE_SIZE = 1024 * 1024
+# Same for the encoded album covers.
+_COVER_CACHE_SIZE = 64 * 1024 * 1024
+# Same for the probe records.
+_PROBE_CACHE_SIZE = 16 * 1024 * 1024
+# Bump on incompatible changes of the probe record.
+_PROBE_VERSION = 2
+# Same for the capabilities.
+_CAPS_VERSION = 2
+# Number and duration of samples used to estimate the whole encode.
+_SAMPLE_COUNT = 4
+_SAMPLE_DURATION = 2
+# Default address of the metrics exporter.
+_METRICS_ADDRESS = '127.0.0.1:9210'
+# Default address of the job server.
+_SERVE_ADDRESS = '127.0.0.1:8210'
+# Finished server jobs above that number are forgotten.
+_SERVE_HISTORY = 1000
+# Options of the server jobs which write files at arbitrary paths or
+# pass raw FFmpeg/mpv options, refused unless --serve-unsafe is given.
+_SERVE_UNSAFE = [
+    'outfile', 'fo', 'foi', 'foi2', 'po', 'vf', 'vfi', 'af',
+    'stats_json', 'metrics_port', 'metrics_textfile', 'progress',
+    'batch', 'batch_report', 'serve',
+]
+# Weight of the latest encode in the learned size correction and its
+# bounds. Encodes that far off are most likely quality bound.
+_SIZESTATS_WEIGHT = 0.3
+_SIZESTATS_MIN = 0.8
+_SIZESTATS_MAX = 1.25
+# Default size of the opt-in output cache, in mebibytes.
+_OUTPUT_CACHE_SIZE = 4096
+# Size of the blocks read to compute content hash of the input.
+_HASH_BLOCK_SIZE = 1024 * 1024
+# Expected size of the lossless -prefilter intermediate in bytes per
+# pixel (raw yuv420p takes 1.5), it's kept in memory only if that takes
+# at most half of the free space there.
+_PREFILTER_BPP = 1
+# Quality of the encoded album covers, and bitrate in kbits of the VP8
+# ones.
+_COVER_CRF = 20
+_COVER_VB = 2000
+# AV1 encoders with their -av1enc names, from the fastest one.
+_AV1_ENCODERS = [
+    ('svt', 'libsvtav1'),
+    ('rav1e', 'librav1e'),
+    ('aom', 'libaom-av1'),
+]
+# Encoders which can't do two-pass encoding in FFmpeg.
+_SINGLEPASS_ENCODERS = ['libsvtav1']
+# Default number of -la attempts for them, since one-pass rate control
+# can't reliably hit the target size.
+_SINGLEPASS_LA = 2
+# Relative time of the last pass at every -speed of the encoders, speed
+# 4 is the unit. -deadline-seconds uses them only as the shape of the
+# curve, the scale is measured; other AV1 encoders follow libaom. Good
+# quality mode of libvpx doesn't go faster than speed 5.
+_SPEED_COSTS = {
+    'libvpx': [4, 2.7, 2.6, 2.5, 1, 0.65, 0.65, 0.65, 0.65],
+    'libvpx-vp9': [5.5, 2.3, 1.4, 1.1, 1, 1, 1, 1, 1],
+    'libaom-av1': [40, 13.5, 3.8, 1.7, 1, 0.65, 0.6, 0.6, 0.55],
+}
+# Progress of the last pass isn't judged before that many seconds, and
+# it's considered behind once projected to miss the deadline by that
+# fraction of it.
+_DEADLINE_GRACE = 5
+_DEADLINE_SLACK = 0.05
+# Codecs of the single-frame inputs which allow cover mode fast path.
+_STILL_CODECS = [
+    'bmp', 'jpeg2000', 'jpegls', 'mjpeg', 'pam', 'pbm', 'pgm', 'png',
+    'ppm', 'qoi', 'tiff', 'webp',
+]
+
+
 # We can't use e.g. ``sys.stdout.encoding`` because user can redirect
 # the output so in Python2 it would return ``None``. Seems like
 # ``getpreferredencoding`` is the best remaining method.
@@ -119,6 +227,28 @@ if _PY2:
     MPV_PATH = MPV_PATH.decode(OS_ENCODING)
 
 
+# Look for ffprobe next to the FFmpeg executable by default.
+FFPROBE_PATH = os.getenv('WEBM_FFPROBE')
+if FFPROBE_PATH is None:
+    FFPROBE_PATH = os.path.join(
+        os.path.dirname(FFMPEG_PATH),
+        os.path.basename(FFMPEG_PATH).replace('ffmpeg', 'ffprobe'))
+if _PY2 and isinstance(FFPROBE_PATH, bytes):
+    FFPROBE_PATH = FFPROBE_PATH.decode(OS_ENCODING)
+
+
+CACHE_DIR = os.getenv('WEBM_CACHE_DIR')
+if CACHE_DIR is None:
+    if _WIN:
+        CACHE_DIR = os.getenv('LOCALAPPDATA') or tempfile.gettempdir()
+    else:
+        CACHE_DIR = os.getenv('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+    CACHE_DIR = os.path.join(CACHE_DIR, __title__)
+if _PY2 and isinstance(CACHE_DIR, bytes):
+    CACHE_DIR = CACHE_DIR.decode(OS_ENCODING)
+
+
 # Fix unicode subprocess arguments on Win+Py2:
 # https://bugs.python.org/issue1759845
 if _WIN and _PY2:
@@ -128,140 +258,667 @@ if _WIN and _PY2:
         pass
 
 
-def _ffmpeg(args, check_code=True, debug=False):
-    args = [FFMPEG_PATH] + args
-    if debug:
-        print('='*50 + '\n' + ' '.join(args) + '\n' + '='*50, file=sys.stderr)
+class FFmpegTimeoutError(FFmpegError):
+    """FFmpeg stage ran longer than allowed by -timeout."""
+
+
+class CancelledError(WebmError):
+    """Encode was cancelled with :meth:`CancelToken.cancel`."""
+
+
+class CancelToken(object):
+    """
+    Kill all child processes started on behalf of the encode, e.g. from
+    another thread. Shared by all sub-encodes (chunks, samples, audio).
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self._kills = set()
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            kills = list(self._kills)
+        for kill in kills:
+            kill()
+
+    def _register(self, kill):
+        with self._lock:
+            if self.cancelled:
+                return False
+            self._kills.add(kill)
+            return True
+
+    def _unregister(self, kill):
+        with self._lock:
+            self._kills.discard(kill)
+
+
+# Time given to the process group to exit after SIGTERM.
+_KILL_GRACE = 2
+_EVENT_LOOP = {}
+_EVENT_LOOP_LOCK = threading.Lock()
+
+
+def _get_event_loop():
+    """
+    Return asyncio loop running in background thread which streams
+    output of all child processes, or None if it's not usable. Pipes of
+    the ordinary processes can't be used with the Windows loop and
+    older Pythons lack the needed APIs, so fall back to threads there.
+    """
+    if _WIN or sys.version_info < (3, 8):
+        return None
+    import asyncio
+    with _EVENT_LOOP_LOCK:
+        loop = _EVENT_LOOP.get('loop')
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever)
+            thread.daemon = True
+            thread.start()
+            _EVENT_LOOP['loop'] = loop
+        return loop
+
+
+def _line_feeder(callback, encoding):
+    """
+    Return function which accepts chunks of data (None on EOF) and calls
+    callback with every decoded line.
+    """
+    state = {'buf': b''}
+
+    def feed(data):
+        if data is None:
+            lines, state['buf'] = [state['buf']] if state['buf'] else [], b''
+        else:
+            lines = (state['buf'] + data).split(b'\n')
+            state['buf'] = lines.pop()
+        for line in lines:
+            # Fix for Windows newlines.
+            callback(line.decode(encoding, 'ignore').rstrip('\r'))
+    return feed
+
+
+def _read_async(loop, pipes):
+    """
+    Feed pipes from the event loop. Return event which is set once all
+    of them are closed.
+    """
+    import asyncio
+    closed = threading.Event()
+    left = [len(pipes)]
+
+    class Protocol(asyncio.Protocol):
+        def __init__(self, feed):
+            self.feed = feed
+
+        def data_received(self, data):
+            self.feed(data)
+
+        def connection_lost(self, exc):
+            self.feed(None)
+            # Always called from the loop thread.
+            left[0] -= 1
+            if not left[0]:
+                closed.set()
+
+    if not pipes:
+        closed.set()
+    for fh, feed in pipes:
+        coro = loop.connect_read_pipe(lambda feed=feed: Protocol(feed), fh)
+        asyncio.run_coroutine_threadsafe(coro, loop).result()
+    return closed
+
+
+def _read_threads(pipes):
+    readers = []
+    for fh, feed in pipes:
+        def read(fh=fh, feed=feed):
+            for data in iter(lambda: os.read(fh.fileno(), 65536), b''):
+                feed(data)
+            feed(None)
+            fh.close()
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+        readers.append(reader)
+    closed = threading.Event()
+
+    def wait():
+        for reader in readers:
+            reader.join()
+        closed.set()
+    waiter = threading.Thread(target=wait)
+    waiter.daemon = True
+    waiter.start()
+    return closed
+
+
+def _wait_process(p):
+    """
+    Wait for process exit and return its resource usage (CPU seconds and
+    peak RSS in KiB) or None if platform can't report it.
+    """
+    if not hasattr(os, 'wait4'):
+        p.wait()
+        return None
+    import errno
+    while True:
+        try:
+            _, status, usage = os.wait4(p.pid, 0)
+            break
+        except OSError as exc:
+            # Py2 doesn't retry on signals.
+            if exc.errno != errno.EINTR:
+                raise
+    p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) \
+        else os.WEXITSTATUS(status)
+    maxrss = usage.ru_maxrss
+    # Bytes on macOS.
+    if sys.platform == 'darwin':
+        maxrss //= 1024
+    return {'user': usage.ru_utime, 'sys': usage.ru_stime, 'maxrss': maxrss}
+
+
+def _kill_process(pid, group, force=False):
+    import signal
     try:
-        p = subprocess.Popen(args)
-    except Exception as exc:
-        raise Exception('failed to run FFmpeg ({})'.format(exc))
-    p.communicate()
-    if check_code and p.returncode != 0:
-        raise Exception('FFmpeg exited with error')
-    return {'code': p.returncode}
+        if _WIN:
+            # Kills the whole tree, there are no signals anyway.
+            with open(os.devnull, 'wb') as devnull:
+                subprocess.call(
+                    ['taskkill', '/F', '/T', '/PID', _TEXT_TYPE(pid)],
+                    stdout=devnull, stderr=devnull)
+        else:
+            sig = signal.SIGKILL if force else signal.SIGTERM
+            (os.killpg if group else os.kill)(pid, sig)
+    except OSError:
+        # Already exited.
+        pass
+
+
+def _run_process(args, on_stdout=None, on_stderr=None, encoding='utf-8',
+                 timeout=None, cancel=None, on_usage=None, new_session=None):
+    """
+    Run process and stream its stdout/stderr line by line to the given
+    callbacks; streams without callback are inherited. Output of all
+    processes is read by the single background event loop (or by
+    threads on Windows and older Pythons) so they may be run from any
+    number of threads. Resource usage of the exited process is passed
+    to on_usage callback.
+
+    Process is killed once it runs longer than timeout, gets cancelled
+    with cancel token or the waiting thread is interrupted. Supervised
+    processes are run in their own session by default so that their
+    children are killed too.
+    """
+    if new_session is None:
+        new_session = timeout is not None or cancel is not None
+    kwargs = {}
+    if on_stdout is not None:
+        kwargs['stdout'] = subprocess.PIPE
+    if on_stderr is not None:
+        kwargs['stderr'] = subprocess.PIPE
+    if new_session:
+        kwargs['stdin'] = open(os.devnull, 'rb')
+        if _WIN:
+            kwargs['creationflags'] = subprocess.CREATE_NEW_PROCESS_GROUP
+        elif _PY2:
+            kwargs['preexec_fn'] = os.setsid
+        else:
+            kwargs['start_new_session'] = True
+    try:
+        p = subprocess.Popen(args, **kwargs)
+    finally:
+        if new_session:
+            kwargs['stdin'].close()
+    pipes = []
+    if on_stdout is not None:
+        pipes.append((p.stdout, _line_feeder(on_stdout, encoding)))
+    if on_stderr is not None:
+        pipes.append((p.stderr, _line_feeder(on_stderr, encoding)))
+    loop = _get_event_loop()
+    closed = _read_async(loop, pipes) if loop else _read_threads(pipes)
+    done = threading.Event()
+    usage = {}
+
+    def wait():
+        usage['usage'] = _wait_process(p)
+        closed.wait()
+        done.set()
+    waiter = threading.Thread(target=wait)
+    waiter.daemon = True
+    waiter.start()
+
+    def kill():
+        if done.is_set():
+            return
+        _kill_process(p.pid, new_session)
+        if not done.wait(_KILL_GRACE):
+            _kill_process(p.pid, new_session, force=True)
+        done.wait()
+
+    if cancel is not None and not cancel._register(kill):
+        kill()
+    deadline = None if timeout is None else time.time() + timeout
+    try:
+        # Wait in short steps, Py2 can't interrupt infinite wait.
+        while not done.wait(1 if deadline is None else
+                            max(0, min(1, deadline - time.time()))):
+            if deadline is not None and time.time() >= deadline:
+                kill()
+                raise FFmpegTimeoutError(
+                    '{} took more than {} seconds'.format(
+                        os.path.basename(args[0]), timeout))
+    except KeyboardInterrupt:
+        kill()
+        raise
+    finally:
+        if cancel is not None:
+            cancel._unregister(kill)
+        if on_usage is not None and done.is_set():
+            on_usage(usage['usage'])
+    if cancel is not None and cancel.cancelled:
+        raise CancelledError('encode was cancelled')
+    return p.returncode
+
+
+def _supervise(options):
+    """
+    Keyword arguments of ``_ffmpeg`` which apply -timeout, cancellation
+    and account resource usage to the current phase of the encode and
+    to ``usages`` list of the sub-encode if it has one.
+    """
+    stats = getattr(options, 'stats', None)
+    usages = getattr(options, 'usages', None)
+    on_usage = stats and stats.add_process
+    if usages is not None:
+        def on_usage(usage, add=on_usage):
+            if add:
+                add(usage)
+            usages.append(usage)
+    return {
+        'timeout': getattr(options, 'timeout', None),
+        'cancel': getattr(options, 'cancel', None),
+        'on_usage': on_usage,
+    }
 
 
-def _ffmpeg_output(args, check_code=True, debug=False):
+def _progress_parser(progress):
+    # Blocks of "key=value" lines, each terminated by "progress=...".
+    block = {}
+
+    def parse(line):
+        key, _, value = line.strip().partition('=')
+        block[key] = value
+        if key == 'progress':
+            progress(dict(block))
+            block.clear()
+    return parse
+
+
+def _ffmpeg(args, check_code=True, debug=False, progress=None,
+            timeout=None, cancel=None, on_usage=None):
     args = [FFMPEG_PATH] + args
+    on_stdout = None
+    if progress is not None:
+        args[1:1] = ['-progress', 'pipe:1']
+        on_stdout = _progress_parser(progress)
     if debug:
         print('='*50 + '\n' + ' '.join(args) + '\n' + '='*50, file=sys.stderr)
     try:
-        p = subprocess.Popen(
-                args, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-    except Exception as exc:
-        raise Exception('failed to run FFmpeg ({})'.format(exc))
-    # These are bytes in both Py2 and 3.
-    out, err = p.communicate()
-    if check_code and p.returncode != 0:
-        raise Exception('FFmpeg exited with error')
-
-    # XXX: Always use UTF-8 because it's what FFmpeg uses, at least on
-    # Windows. Let's ignore non-UTF8 nix systems for now.
-    out = out.decode('utf-8', 'ignore')
-    err = err.decode('utf-8', 'ignore')
-    # Fix for Windows newlines.
-    out = out.replace('\r\n', '\n')
-    err = err.replace('\r\n', '\n')
-
-    return {'stdout': out, 'stderr': err, 'code': p.returncode}
+        code = _run_process(
+            args, on_stdout=on_stdout, timeout=timeout, cancel=cancel,
+            on_usage=on_usage)
+    except EnvironmentError as exc:
+        raise FFmpegError('failed to run FFmpeg ({})'.format(exc))
+    if check_code and code != 0:
+        raise FFmpegError('FFmpeg exited with error')
+    return {'code': code}
+
+
+def _ffmpeg_output(args, check_code=True, debug=False, ffprobe=False,
+                   on_stdout=None, timeout=None, cancel=None,
+                   on_usage=None):
+    """
+    Run FFmpeg (or ffprobe) and return its output. If on_stdout callback
+    is given, stdout lines are passed to it instead of being collected
+    so long outputs don't have to be kept in memory.
+    """
+    args = [FFPROBE_PATH if ffprobe else FFMPEG_PATH] + args
+    if debug:
+        print('='*50 + '\n' + ' '.join(args) + '\n' + '='*50, file=sys.stderr)
+    out = []
+    err = []
+    try:
+        # XXX: Always use UTF-8 because it's what FFmpeg uses, at least
+        # on Windows. Let's ignore non-UTF8 nix systems for now.
+        code = _run_process(
+            args, on_stdout=on_stdout or out.append, on_stderr=err.append,
+            timeout=timeout, cancel=cancel, on_usage=on_usage)
+    except EnvironmentError as exc:
+        raise FFmpegError('failed to run FFmpeg ({})'.format(exc))
+    if check_code and code != 0:
+        raise FFmpegError('FFmpeg exited with error')
+    return {'stdout': '\n'.join(out), 'stderr': '\n'.join(err), 'code': code}
 
 
 def _mpv_output(args, check_code=True, catch_stdout=True, debug=False):
     args = [MPV_PATH] + args
     if debug:
         print('='*50 + '\n' + ' '.join(args) + '\n' + '='*50, file=sys.stderr)
-    kwargs = {'stdout': subprocess.PIPE} if catch_stdout else {}
+    out = []
+    err = []
     try:
-        p = subprocess.Popen(
-            args, stderr=subprocess.PIPE,
-            universal_newlines=True,
-            **kwargs)
-    except Exception as exc:
-        raise Exception('failed to run mpv ({})'.format(exc))
-    out, err = p.communicate()
-    if check_code and p.returncode != 0:
-        raise Exception('mpv exited with error')
-    if _PY2:
-        if catch_stdout:
-            out = out.decode(OS_ENCODING)
-        err = err.decode(OS_ENCODING)
-    return {'stdout': out, 'stderr': err, 'code': p.returncode}
+        # Keep interactive player in the terminal's session.
+        code = _run_process(
+            args, on_stdout=out.append if catch_stdout else None,
+            on_stderr=err.append, encoding=OS_ENCODING, new_session=False)
+    except EnvironmentError as exc:
+        raise DependencyError('failed to run mpv ({})'.format(exc))
+    if check_code and code != 0:
+        raise WebmError('mpv exited with error')
+    return {'stdout': '\n'.join(out), 'stderr': '\n'.join(err), 'code': code}
+
+
+def _which(path):
+    """
+    Resolve executable location the same way subprocess would do.
+    """
+    if os.path.dirname(path):
+        return os.path.abspath(path) if os.path.isfile(path) else None
+    exts = ['']
+    if _WIN:
+        exts += os.getenv('PATHEXT', '.EXE').lower().split(os.pathsep)
+    for dirname in os.getenv('PATH', '').split(os.pathsep):
+        for ext in exts:
+            fpath = os.path.join(dirname, path + ext)
+            if os.path.isfile(fpath):
+                return os.path.abspath(fpath)
+
+
+def _file_identity(path):
+    path = os.path.realpath(path)
+    st = os.stat(path)
+    mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+    return [path, st.st_size, mtime, st.st_ino]
+
+
+def _read_json(path, default=None):
+    try:
+        with open(path, 'rb') as fh:
+            return json.loads(fh.read().decode('utf-8'))
+    except Exception:
+        return default
+
+
+def _write_json(path, data):
+    _write_atomic(path, json.dumps(data, sort_keys=True).encode('utf-8'))
+
+
+def _write_atomic(path, data):
+    """
+    Atomically replace the file so concurrent readers never see
+    partially written data.
+    """
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Created by concurrent process.
+            if not os.path.isdir(dirname):
+                raise
+    fh, tmppath = tempfile.mkstemp(suffix='.tmp', dir=dirname)
+    try:
+        os.write(fh, data)
+    finally:
+        os.close(fh)
+    try:
+        getattr(os, 'replace', os.rename)(tmppath, path)
+    except Exception:
+        os.remove(tmppath)
+        raise
+
+
+def _copy_atomic(src, path):
+    """
+    Copy file through unique temporary file in the destination
+    directory so concurrent writers of the same path don't clash.
+    """
+    fh, tmppath = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    os.close(fh)
+    try:
+        shutil.copyfile(src, tmppath)
+        getattr(os, 'replace', os.rename)(tmppath, path)
+    except Exception:
+        os.remove(tmppath)
+        raise
+
+
+def _cached_probe(binary, probe, refresh=False):
+    """
+    Run probe function only if there is no cached result for the
+    current version of the given binary. Cache is keyed by the resolved
+    location of binary and invalidated once its size, mtime or inode
+    changes, i.e. on every upgrade.
+    """
+    try:
+        identity = _file_identity(_which(binary)) + [_CAPS_VERSION]
+    except Exception:
+        # Not found or not accessible, let the probe fail the usual way.
+        return probe()
+    cachefile = os.path.join(CACHE_DIR, 'caps.json')
+    cache = _read_json(cachefile, {})
+    entry = cache.get(identity[0])
+    if not refresh and entry and entry.get('identity') == identity:
+        return entry['data']
+    data = probe()
+    cache[identity[0]] = {'identity': identity, 'data': data}
+    try:
+        _write_json(cachefile, cache)
+    except Exception:
+        # Cache is optional, next run will just probe again.
+        pass
+    return data
+
+
+def _probe_ffmpeg():
+    ffverout = _ffmpeg_output(['-version'])['stdout']
+    try:
+        line = ffverout.split('\n', 1)[0]
+        ffmpegv = re.match(r'ffmpeg version (\S+)', line).group(1)
+    except Exception:
+        raise DependencyError('cannot parse FFmpeg version')
+
+    codecout = _ffmpeg_output(['-hide_banner', '-codecs'])['stdout']
+    encoders = set()
+    # Skip legend, codec list starts after the " -------" line.
+    codecout = codecout.split(' -------\n', 1)[-1]
+    for line in codecout.split('\n'):
+        # E.g. " DEV.L. vp9  Google VP9 (decoders: vp9) (encoders: libvpx-vp9)"
+        m = re.match(r'\s*[D.]E[VAS.]\S*\s+(\S+)', line)
+        if not m:
+            continue
+        named = re.search(r'\(encoders: ([^)]+)\)', line)
+        if named:
+            encoders.update(named.group(1).split())
+        else:
+            encoders.add(m.group(1))
+
+    vp9out = _ffmpeg_output(
+        ['-hide_banner', '-h', 'encoder=libvpx-vp9'])['stdout']
+    row_mt = '-row-mt' in vp9out
+    aomout = _ffmpeg_output(
+        ['-hide_banner', '-h', 'encoder=libaom-av1'])['stdout']
+
+    return {
+        'ffmpegv': ffmpegv,
+        'encoders': sorted(encoders),
+        'row_mt': row_mt,
+        'aom_row_mt': '-row-mt' in aomout,
+        'aom_tile_rows': '-tile-rows' in aomout,
+    }
+
+
+def _probe_mpv():
+    mverout = _mpv_output(['--version'])['stdout']
+    m = re.match(r'mpv (\S+)', mverout)
+    return {'mpvv': m.group(1) if m else None}
 
 
-def get_capabilities():
+def _read_cgroup_file(path):
+    try:
+        with open(path) as fh:
+            return fh.read().split()
+    except Exception:
+        return None
+
+
+def _get_cgroup_quota():
+    """
+    Return CPU limit of the current cgroup (and its ancestors) as
+    fractional number of CPUs or None if it's not limited. Both cgroup
+    v2 ``cpu.max`` and v1 ``cpu.cfs_quota_us`` are supported.
+    """
+    try:
+        with open('/proc/self/cgroup') as fh:
+            lines = fh.read().splitlines()
+    except Exception:
+        return None
+    quotas = []
+    for line in lines:
+        if line.count(':') < 2:
+            continue
+        _, controllers, path = line.split(':', 2)
+        if controllers == '':
+            root = '/sys/fs/cgroup'
+            limitfile, periodfile = 'cpu.max', None
+        elif 'cpu' in controllers.split(','):
+            root = os.path.join('/sys/fs/cgroup', controllers)
+            if not os.path.isdir(root):
+                root = '/sys/fs/cgroup/cpu'
+            limitfile, periodfile = 'cpu.cfs_quota_us', 'cpu.cfs_period_us'
+        else:
+            continue
+        # Inside of container namespace path may be absent, so check
+        # every level down to the mount point.
+        path = path.strip('/')
+        while True:
+            dirname = os.path.join(root, path)
+            limit = _read_cgroup_file(os.path.join(dirname, limitfile))
+            if periodfile is not None and limit is not None:
+                limit += _read_cgroup_file(
+                    os.path.join(dirname, periodfile)) or []
+            if limit is not None and len(limit) == 2 and \
+                    limit[0] not in ('max', '-1'):
+                quotas.append(int(limit[0]) / int(limit[1]))
+            if not path:
+                break
+            path = os.path.dirname(path)
+    return min(quotas) if quotas else None
+
+
+def get_cpu_budget():
+    """
+    Return number of CPU threads the encode may actually use and the
+    description of where the number comes from. Unlike ``cpu_count``
+    this respects CPU affinity and cgroup quota of containers.
+    """
+    import multiprocessing
+    try:
+        cpus = len(os.sched_getaffinity(0))
+        source = 'affinity'
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+        source = 'cpu count'
+    quota = _get_cgroup_quota()
+    if quota is not None and quota < cpus:
+        cpus = max(1, int(math.ceil(quota)))
+        source = 'cgroup quota {:g}'.format(quota)
+    return cpus, source
+
+
+def get_capabilities(args=None):
+    """
+    Probe FFmpeg and mpv. Encoders and mpv are checked only if the
+    given command-line arguments (default: program arguments) need them.
+    """
+    if args is None:
+        args = ARGS
     pythonv = '{}.{}.{}'.format(*sys.version_info)
     if ((sys.version_info[0] == 2 and sys.version_info[1] < 7) or
             (sys.version_info[0] == 3 and sys.version_info[1] < 2) or
             # Just in case... Also don't restrict <= 3, script might
             # work on Python 4+ too.
             sys.version_info[0] < 2):
-        raise Exception(
+        raise DependencyError(
             'Python version must be 2.7+ or 3.2+, using: {}'.format(pythonv))
 
-    ffverout = _ffmpeg_output(['-version'])['stdout']
-    try:
-        line = ffverout.split('\n', 1)[0]
-        ffmpegv = re.match(r'ffmpeg version (\S+)', line).group(1)
-    except Exception:
-        raise Exception('cannot parse FFmpeg version')
+    refresh = '--refresh-caps' in args
+    ffcaps = _cached_probe(FFMPEG_PATH, _probe_ffmpeg, refresh)
+    ffmpegv = ffcaps['ffmpegv']
     # NOTE: Checking only for '^x.y.z', possible non-numeric symbols
     # after 'z' don't matter.
     if re.match(r'\d+\.\d+\.\d+', ffmpegv):
         if int(ffmpegv.split('.', 1)[0]) < 2:
-            raise Exception('FFmpeg version must be 2+, '
-                            'using: {}'.format(ffmpegv))
+            raise DependencyError('FFmpeg version must be 2+, '
+                                  'using: {}'.format(ffmpegv))
     else:
         # Most probably version from git. Do nothing.
         pass
 
-    codecout = _ffmpeg_output(['-hide_banner', '-codecs'])['stdout']
-    if not re.search(r'\bencoders:.*\blibvpx-vp9\b', codecout):
-        raise Exception('FFmpeg is not compiled with libvpx VP9 support')
-    if not re.search(r'\bencoders:.*\blibopus\b', codecout):
-        raise Exception('FFmpeg is not compiled with libopus support')
-    if '-av1' in ARGS:
-        if not re.search(r'\bencoders:.*\blibaom-av1\b', codecout):
-            raise Exception('FFmpeg is not compiled with libaom support')
-    if '-vp8' in ARGS:
-        if not re.search(r'\bencoders:.*\blibvpx\b', codecout):
-            raise Exception('FFmpeg is not compiled with libvpx support')
-    if ('-vorbis' in ARGS or
-            ('-vp8' in ARGS and '-opus' not in ARGS)):
-        if not re.search(r'\bencoders:.*\blibvorbis\b', codecout):
-            raise Exception('FFmpeg is not compiled with libvorbis support')
-
-    vp9out = _ffmpeg_output(
-        ['-hide_banner', '-h', 'encoder=libvpx-vp9'])['stdout']
-    row_mt = '-row-mt' in vp9out
+    encoders = ffcaps['encoders']
+    if 'libvpx-vp9' not in encoders:
+        raise DependencyError(
+            'FFmpeg is not compiled with libvpx VP9 support')
+    if 'libopus' not in encoders:
+        raise DependencyError('FFmpeg is not compiled with libopus support')
+    if '-av1' in args:
+        if not any(name in encoders for _, name in _AV1_ENCODERS):
+            raise DependencyError(
+                'FFmpeg is not compiled with libsvtav1, librav1e or '
+                'libaom support')
+    if '-vp8' in args:
+        if 'libvpx' not in encoders:
+            raise DependencyError('FFmpeg is not compiled with libvpx support')
+    if ('-vorbis' in args or
+            ('-vp8' in args and '-opus' not in args)):
+        if 'libvorbis' not in encoders:
+            raise DependencyError(
+                'FFmpeg is not compiled with libvorbis support')
 
     mpvv = 'n/a'
-    need_mpv = '-p' in ARGS
+    need_mpv = '-p' in args
     try:
-        mverout = _mpv_output(['--version'])['stdout']
+        mpvcaps = _cached_probe(MPV_PATH, _probe_mpv, refresh)
     except Exception:
         if need_mpv:
             raise
     else:
-        try:
-            mpvv = re.match(r'mpv (\S+)', mverout).group(1)
-        except Exception:
-            if need_mpv:
-                raise Exception('cannot parse mpv version')
+        if mpvcaps['mpvv'] is not None:
+            mpvv = mpvcaps['mpvv']
+        elif need_mpv:
+            raise DependencyError('cannot parse mpv version')
         if need_mpv:
             if not re.match(r'\d+\.\d+\.\d+', mpvv):
-                raise Exception('cannot parse mpv version')
+                raise DependencyError('cannot parse mpv version')
             major, minor = mpvv.split('.', 2)[:2]
             major, minor = int(major), int(minor)
             if major == 0 and minor < 17:
-                raise Exception('mpv version must be 0.17+, '
-                                'using: {}'.format(mpvv))
+                raise DependencyError('mpv version must be 0.17+, '
+                                      'using: {}'.format(mpvv))
 
     return {
         'pythonv': pythonv,
         'ffmpegv': ffmpegv,
-        'row_mt': row_mt,
+        'encoders': encoders,
+        'row_mt': ffcaps['row_mt'],
+        'aom_row_mt': ffcaps['aom_row_mt'],
+        'aom_tile_rows': ffcaps['aom_tile_rows'],
         'mpvv': mpvv,
     }
 
@@ -299,12 +956,33 @@ def _vorbisq2bitrate(q):
     }[q]
 
 
+def _get_av1_encoder(name, caps):
+    """
+    Return FFmpeg encoder of the given -av1enc backend or the fastest
+    available one.
+    """
+    if name is not None:
+        return dict(_AV1_ENCODERS)[name]
+    for _, encoder in _AV1_ENCODERS:
+        if encoder in caps['encoders']:
+            return encoder
+    # Checkings are disabled, use the reference encoder.
+    return 'libaom-av1'
+
+
 def _get_main_infile(options):
     return options.infile if options.cover is None else options.aa
 
 
-def process_options(caps):
+def _get_parser(caps, exit_on_error=True):
     import argparse
+
+    class ArgumentParser(argparse.ArgumentParser):
+        def error(self, message):
+            if exit_on_error:
+                argparse.ArgumentParser.error(self, message)
+            raise OptionsError(message)
+
     doc = __doc__.format(stitle=__stitle__, **caps)
     ffcaps = ' (ROW-MT)' if caps['row_mt'] else ''
     verstr = (
@@ -313,7 +991,7 @@ def process_options(caps):
         'ffmpeg\t{ffmpegv}{}\n'
         'mpv\t{mpvv}'.format(__title__, __version__, ffcaps, **caps))
 
-    parser = argparse.ArgumentParser(
+    parser = ArgumentParser(
         prog=__stitle__,
         description=doc,
         formatter_class=argparse.RawTextHelpFormatter)
@@ -352,10 +1030,31 @@ def process_options(caps):
         '-l', metavar='limit', type=float,
         help='target filesize limit in mebibytes\n'
              '-l and -vb are mutually exclusive')
+    parser.add_argument(
+        '-autocrf', action='store_true',
+        help='pick the best quality level which fits -l by encoding\n'
+             'a few short samples, video bitrate is used as upper bound\n'
+             'you cannot use -autocrf with -crf')
+    parser.add_argument(
+        '-la', metavar='attempts', type=int,
+        help='re-run the last pass up to this number of times with\n'
+             'corrected video bitrate if output does not fit -l\n'
+             'first pass is not repeated (default: 0, {} for\n'
+             'single-pass AV1 encoders)'.format(_SINGLEPASS_LA))
+    parser.add_argument(
+        '-lt', metavar='tolerance', type=float, default=5,
+        help='acceptable underweight for -la in percents of -l\n'
+             'ignored if -crf is given (default: 5)')
     parser.add_argument(
         '-av1', action='store_true',
         help='use AV1 codec for video\n'
              '-av1 and -vp8 are mutually exclusive')
+    parser.add_argument(
+        '-av1enc', metavar='encoder', choices=[e for e, _ in _AV1_ENCODERS],
+        help='AV1 encoder to use: svt (libsvtav1, single-pass only),\n'
+             'rav1e (librav1e) or aom (libaom-av1)\n'
+             'by default the fastest available one, in that order\n'
+             'you cannot use -qmin, -qmax with rav1e')
     parser.add_argument(
         '-vp8', action='store_true',
         help='use VP8 codec for video, implies -vorbis')
@@ -487,6 +1186,49 @@ def process_options(caps):
         '-foi2', metavar='ffmpegopts',
         help='raw FFmpeg options to insert after first input\n'
              "example: -foi2='-itsoffset 10' (equal sign is mandatory)")
+    parser.add_argument(
+        '-chunks', metavar='count', type=int, const=0, nargs='?',
+        help='split input at keyframes into chunks and encode them in\n'
+             'parallel, by default one chunk per 4 CPU threads is used\n'
+             'video bitrate is shared across chunks according to their\n'
+             'complexity, so -l still holds for the whole file\n'
+             'you cannot use -chunks with -cover')
+    parser.add_argument(
+        '-noremux', action='store_true',
+        help='always re-encode; by default input which already has\n'
+             'compatible codecs and fits -l or -vb is just remuxed')
+    parser.add_argument(
+        '-smartcut', action='store_true',
+        help='if input already has compatible codecs, re-encode only\n'
+             'the part before the first keyframe of the fragment and\n'
+             'copy the rest; quality of the copied part is the same\n'
+             'as of input, but -l/-vb are still checked')
+    parser.add_argument(
+        '-prefilter', action='store_true',
+        help='decode, cut and filter input only once into lossless\n'
+             'temporary file (in memory if possible) and run both\n'
+             'passes from it; speeds up encodes with heavy sources\n'
+             'or subtitles at the cost of temporary space\n'
+             'you cannot use -prefilter with -chunks, -cover, -1\n'
+             'and single-pass AV1 encoders')
+    parser.add_argument(
+        '-threads', metavar='threads', type=int,
+        help='number of CPU threads to use\n'
+             'by default all CPUs available to the process (with\n'
+             'respect to affinity and cgroup quota) are used')
+    parser.add_argument(
+        '-timeout', metavar='seconds', type=float,
+        help='fail the encode if any single FFmpeg run (pass, chunk,\n'
+             'sample, etc.) takes longer than that; FFmpeg and its\n'
+             'children are killed')
+    parser.add_argument(
+        '-deadline-seconds', metavar='seconds', type=float,
+        help='pick the slowest (best) speed of the last pass which is\n'
+             'projected to finish the encode within that time, measured\n'
+             'on a short sample; the last pass is restarted with faster\n'
+             'speed if it falls behind; -speed is the slowest allowed\n'
+             'one (default: 0)\n'
+             'you cannot use -deadline-seconds with -chunks')
     parser.add_argument(
         '-cn', action='store_true',
         help='skip any dependency/version checkings\n'
@@ -495,12 +1237,105 @@ def process_options(caps):
         '-1', action='store_true', dest='singlepass',
         help='use single pass encoding\n'
              'advanced option, not recommended')
+    parser.add_argument(
+        '--refresh-caps', action='store_true',
+        help='ignore cached FFmpeg/mpv capabilities and probe them again\n'
+             'they are re-probed automatically once binary is changed')
+    parser.add_argument(
+        '--no-passlog-cache', action='store_true',
+        help="don't reuse first pass statistics of the previous encodes\n"
+             'by default they are reused when only bitrate, audio or\n'
+             'metadata options were changed')
+    parser.add_argument(
+        '--no-size-stats', action='store_true',
+        help="don't learn from and apply the correction of the video\n"
+             'bitrate calculated for -l; by default actual size of\n'
+             'the previous encodes of similar duration/resolution is\n'
+             'used to account container overhead and encoder drift')
+    parser.add_argument(
+        '--output-cache', metavar='maxsize', type=float, nargs='?',
+        const=_OUTPUT_CACHE_SIZE,
+        help='reuse output of the previous encode with the same input\n'
+             'content and effective FFmpeg arguments; the oldest\n'
+             'outputs are evicted once cache exceeds maxsize\n'
+             '(in mebibytes, default: {})'.format(_OUTPUT_CACHE_SIZE))
+    parser.add_argument(
+        '-q', action='store_true', dest='quiet',
+        help='hide FFmpeg output and executed commands')
+    parser.add_argument(
+        '--estimate', action='store_true',
+        help="don't encode, print JSON estimation of output size and\n"
+             'CPU time instead; it is extrapolated from a few short\n'
+             'samples encoded with the same settings')
+    parser.add_argument(
+        '--stats-json', metavar='statsfile',
+        help='write JSON report of the encode phases (probe, passes,\n'
+             'cleanup, etc.) to the given file: wall time, CPU time\n'
+             'and peak RSS of FFmpeg processes, fps and realtime factor')
+    parser.add_argument(
+        '--metrics-port', metavar='address', const=_METRICS_ADDRESS,
+        nargs='?',
+        help='serve OpenMetrics counters and histograms of the jobs,\n'
+             'phases, bytes, FFmpeg failures and -l outcomes on\n'
+             'GET /metrics; address is [host:]port (default: {})'.format(
+                 _METRICS_ADDRESS))
+    parser.add_argument(
+        '--metrics-textfile', metavar='path',
+        help='write the same metrics to the given file after every job,\n'
+             'e.g. for node_exporter textfile collector')
+    parser.add_argument(
+        '--progress', metavar='target',
+        help='write encoding progress as newline-delimited JSON events\n'
+             'target is either file descriptor number or file path\n'
+             'events contain pass number, frame, fps, out_time,\n'
+             'total_size, speed, percent of output duration and ETA')
+    parser.add_argument(
+        '--batch', metavar='manifest',
+        help='encode all files from JSON or CSV manifest\n'
+             'JSON manifest is a list of objects, CSV manifest has a header\n'
+             'keys are option names without dashes, e.g. "i", "l", "av1",\n'
+             '"outfile"; other command-line options apply to every job\n'
+             'batch mode is also enabled by passing several -i options')
+    parser.add_argument(
+        '--jobs', metavar='count', type=int,
+        help='number of concurrent batch or server jobs\n'
+             'by default one job per 4 CPU threads is run, CPU threads\n'
+             'are shared equally between the jobs')
+    parser.add_argument(
+        '--batch-report', metavar='reportfile',
+        help='write JSON report of the batch jobs to the given file')
+    parser.add_argument(
+        '--serve', metavar='address', const=_SERVE_ADDRESS, nargs='?',
+        help='run as a server accepting encode jobs over HTTP\n'
+             'address is [host:]port or unix:path (default: {})\n'
+             'POST /jobs with JSON object of options (keys as in batch\n'
+             'manifest) to submit a job, GET /jobs/<id> to check it,\n'
+             'DELETE /jobs/<id> to cancel it, GET /metrics for\n'
+             'OpenMetrics; other command-line options apply to every job\n'
+             'POST and DELETE must not carry Origin header, POST must\n'
+             'have application/json content type'
+             .format(
+                 _SERVE_ADDRESS))
+    parser.add_argument(
+        '--serve-unsafe', action='store_true',
+        help='allow server jobs to set output and report paths, raw\n'
+             'FFmpeg/mpv options and filters; any client can then write\n'
+             'files as the server user, use only with trusted clients')
+    return parser
+
+
+def _get_default_speed(options):
+    return 4 if options.av1 else 0 if options.vp8 else 1
+
+
+def process_options(caps, args=None, exit_on_error=True):
+    parser = _get_parser(caps, exit_on_error)
 
     # Additional input options validation.
     # NOTE: We ensure only minimal checkings here to not restrict the
     # possible weird uses. E.g. ow, oh, si can be zero or negative; vs,
     # as can be arbitrary.
-    options = parser.parse_args(ARGS)
+    options = parser.parse_args(ARGS if args is None else args)
     if options.t is not None and options.to is not None:
         parser.error('-t and -to are mutually exclusive')
     if options.vb:
@@ -515,11 +1350,47 @@ def process_options(caps):
                 options.crf = 25
         elif options.l <= 0:  # noqa: E741
             parser.error('bad limit value')
+    if options.autocrf:
+        if options.l is None:
+            parser.error('you cannot use -autocrf without -l')
+        if options.crf is not None:
+            parser.error('you cannot use -autocrf with -crf')
+    if options.la:
+        if options.l is None:
+            parser.error('you cannot use -la without -l')
+        if options.la < 0:
+            parser.error('number of attempts must not be negative')
+    if not 0 < options.lt < 100:
+        parser.error('tolerance must be in (0..100) range')
     if options.av1 and options.vp8:
         parser.error('-av1 and -vp8 are mutually exclusive')
     options.vp9 = not options.av1 and not options.vp8
+    if options.av1enc is not None and not options.av1:
+        parser.error('you cannot use -av1enc without -av1')
+    if options.av1:
+        options.av1enc = _get_av1_encoder(options.av1enc, caps)
+        if caps['encoders'] and options.av1enc not in caps['encoders']:
+            raise DependencyError('FFmpeg is not compiled with {} support'
+                                  .format(options.av1enc))
+        if options.av1enc == 'librav1e' and \
+                (options.qmin is not None or options.qmax is not None):
+            # Generic FFmpeg options can't hold rav1e quantizers.
+            parser.error('you cannot use -qmin, -qmax with rav1e, '
+                         'select other encoder with -av1enc')
+        if options.av1enc in _SINGLEPASS_ENCODERS:
+            options.singlepass = True
+            if options.l is not None and options.la is None:
+                options.la = _SINGLEPASS_LA
+    if options.la is None:
+        options.la = 0
+    if options.deadline_seconds is not None:
+        if options.deadline_seconds <= 0:
+            parser.error('deadline must be positive')
+        if options.chunks is not None:
+            parser.error('you cannot use -deadline-seconds with -chunks')
+        options.deadline_speed = options.speed or 0
     if options.speed is None:
-        options.speed = 4 if options.av1 else 0 if options.vp8 else 1
+        options.speed = _get_default_speed(options)
     elif not 0 <= options.speed <= 8:
         parser.error('compression effeciency must be in [0..8] range')
     if options.crf is not None and not 0 <= options.crf <= 63:
@@ -595,6 +1466,22 @@ def process_options(caps):
         # TODO: Probably we should also restrict most other options.
         if options.sa is not None or options.p:
             parser.error('you cannot use -cover with -sa, -p')
+        if options.chunks is not None:
+            parser.error('you cannot use -cover with -chunks')
+        if options.prefilter:
+            parser.error('you cannot use -cover with -prefilter')
+    if options.prefilter and options.chunks is not None:
+        parser.error('you cannot use -prefilter with -chunks')
+    if options.prefilter and options.singlepass:
+        parser.error('you cannot use -prefilter with single-pass encoding')
+    if options.chunks is not None and options.chunks < 0:
+        parser.error('number of chunks must not be negative')
+    if options.threads is not None and options.threads < 1:
+        parser.error('number of threads must be positive')
+    if options.timeout is not None and options.timeout <= 0:
+        parser.error('timeout must be positive')
+    if options.output_cache is not None and options.output_cache <= 0:
+        parser.error('output cache size must be positive')
     if options.mn:
         if options.mt is not None or options.mc:
             parser.error('you cannot use -mn with -mt, -mc')
@@ -619,7 +1506,7 @@ def _parse_time(time):
     # [hh]:[mm]:[ss[.xxx]]
     m = re.match(r'(?:(\d+):)?(?:(\d+)+:)?(\d+(?:\.\d+)?)$', time)
     if not m:
-        raise Exception('invalid time {}'.format(time))
+        raise OptionsError('invalid time {}'.format(time))
     hours, minutes, seconds = m.groups()
     duration = float(seconds)
     if hours is not None:
@@ -830,66 +1717,323 @@ def print_interactive_help():
         _doc2help(print_interactive_help.__doc__)))
 
 
-def _get_input_info(options):
-    infile = _get_main_infile(options)
-    # NOTE: Better to use ffprobe(1) configurable output like suggested
-    # here: <http://stackoverflow.com/a/22243834>, but it brings its own
-    # disadvantage: we must be sure target system has `ffprobe`
-    # executable too.
+def _to_number(value, conv=float):
+    try:
+        return conv(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_rate(rate):
+    # E.g. "24000/1001".
+    try:
+        num, den = rate.split('/')
+        return int(num) / int(den) if int(den) else None
+    except Exception:
+        return _to_number(rate)
+
+
+def _probe_ffprobe(path):
+    out = _ffmpeg_output([
+        '-v', 'error', '-print_format', 'json',
+        '-show_format', '-show_streams', path,
+    ], ffprobe=True)['stdout']
+    data = json.loads(out)
+    fmt = data.get('format', {})
+    streams = []
+    for stream in data.get('streams', []):
+        rate = stream.get('avg_frame_rate')
+        if not _parse_rate(rate):
+            rate = stream.get('r_frame_rate')
+        disposition = stream.get('disposition', {})
+        streams.append({
+            'index': stream.get('index'),
+            'type': stream.get('codec_type'),
+            'codec': stream.get('codec_name'),
+            'pix_fmt': stream.get('pix_fmt'),
+            'width': stream.get('width'),
+            'height': stream.get('height'),
+            'fps': _parse_rate(rate),
+            'bit_rate': _to_number(stream.get('bit_rate'), int),
+            'duration': _to_number(stream.get('duration')),
+            'channels': stream.get('channels'),
+            'sample_rate': _to_number(stream.get('sample_rate'), int),
+            'attached_pic': bool(disposition.get('attached_pic')),
+            'tags': dict((k.lower(), v)
+                         for k, v in stream.get('tags', {}).items()),
+        })
+    return {
+        'format': fmt.get('format_name'),
+        'duration': _to_number(fmt.get('duration')),
+        'start_time': _to_number(fmt.get('start_time')),
+        'bit_rate': _to_number(fmt.get('bit_rate'), int),
+        'tags': dict((k.lower(), v) for k, v in fmt.get('tags', {}).items()),
+        'streams': streams,
+    }
+
+
+def _probe_ffmpeg_stderr(path):
+    """
+    Fallback for systems without ffprobe: scrape human-readable FFmpeg
+    output. Less precise but good enough for our needs.
+    """
     out = _ffmpeg_output(
-        ['-hide_banner', '-i', infile],
+        ['-hide_banner', '-i', path],
         check_code=False)['stderr']
+    m = re.search(
+        r'^\s+Duration: ([^,]+)(?:, start: ([^,]+))?'
+        r'(?:, bitrate: (\d+) kb/s)?', out, re.MULTILINE)
+    if not m:
+        raise FFmpegError('failed to parse duration of input file')
+    dur, start, bitrate = m.groups()
+    fmt = re.search(r"^Input #0, ([^ ]+), from", out, re.MULTILINE)
+
+    tags = {}
+    for key in ('title', 'album'):
+        tag = re.search(
+            r'^\s*{}\s*:\s*(.+)$'.format(key), out,
+            re.MULTILINE | re.IGNORECASE)
+        if tag:
+            tags[key] = tag.group(1)
+
+    streams = []
+    # E.g. "Stream #0:0(und): Video: h264 (High), yuv420p(progressive),
+    # 320x240 [SAR 1:1 DAR 4:3], 250 kb/s, 24 fps, 24 tbr (default)"
+    for m in re.finditer(
+            r'^\s*Stream #\d+:(\d+)\S*: (\w+): (\w+)(.*)$', out,
+            re.MULTILINE):
+        index, stype, codec, rest = m.groups()
+        stream = {
+            'index': int(index),
+            'type': stype.lower(),
+            'codec': codec,
+            'pix_fmt': None,
+            'width': None,
+            'height': None,
+            'fps': None,
+            'bit_rate': None,
+            'duration': None,
+            'channels': None,
+            'sample_rate': None,
+            'attached_pic': 'attached pic' in rest,
+            'tags': {},
+        }
+        fields = [f.strip() for f in re.sub(r'\([^)]*\)', '', rest).split(',')]
+        if stream['type'] == 'video' and len(fields) > 1:
+            stream['pix_fmt'] = fields[1] or None
+        size = re.search(r', (\d+)x(\d+)', rest)
+        if size:
+            stream['width'], stream['height'] = map(int, size.groups())
+        fps = re.search(r', ([\d.]+k?) (?:fps|tbr)', rest)
+        if fps:
+            fps = fps.group(1)
+            fps = float(fps[:-1]) * 1000 if fps.endswith('k') else float(fps)
+            stream['fps'] = fps
+        br = re.search(r', (\d+) kb/s', rest)
+        if br:
+            stream['bit_rate'] = int(br.group(1)) * 1000
+        rate = re.search(r', (\d+) Hz, ([^,]+)', rest)
+        if rate:
+            stream['sample_rate'] = int(rate.group(1))
+            # E.g. "mono", "stereo", "5.1(side)", "3 channels".
+            layout = rate.group(2).strip()
+            channels = re.match(r'(\d+) channels', layout)
+            if channels:
+                stream['channels'] = int(channels.group(1))
+            elif layout in ('mono', 'stereo'):
+                stream['channels'] = 1 if layout == 'mono' else 2
+            else:
+                stream['channels'] = sum(
+                    int(n) for n in re.findall(r'\d+', layout)) or None
+        streams.append(stream)
+
+    return {
+        'format': fmt.group(1) if fmt else None,
+        'duration': None if dur == 'N/A' else _parse_time(dur),
+        'start_time': _to_number(start),
+        'bit_rate': None if bitrate is None else int(bitrate) * 1000,
+        'tags': tags,
+        'streams': streams,
+    }
+
+
+_PROBE_MEMO = {}
+_PROBE_LOCK = threading.Lock()
+
+
+def _get_probe_cachefile(path):
     try:
-        dur = re.search(r'^\s+Duration: ([^,]+)', out, re.MULTILINE).group(1)
+        key = [_PROBE_VERSION, _file_identity(path)]
     except Exception:
-        raise Exception('failed to parse duration of input file')
-    else:
-        induration = _parse_time(dur)
+        # E.g. input is URL.
+        return None
+    key = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, 'probes', key + '.json')
+
+
+def _save_probe(cachefile, record):
+    with _PROBE_LOCK:
+        _PROBE_MEMO[cachefile] = record
+    try:
+        _write_json(cachefile, record)
+        _prune_cache(os.path.dirname(cachefile), _PROBE_CACHE_SIZE)
+    except Exception:
+        # Cache is optional.
+        pass
+
+
+def probe_input(path):
+    """
+    Return information about the given media file: format, duration,
+    bitrate, tags and list of streams with codec, resolution, pixel
+    format, frame rate and bitrate. Use ffprobe if available and
+    FFmpeg output otherwise. Results are memoized on disk, keyed by
+    path, size and mtime of the file.
+    """
+    cachefile = _get_probe_cachefile(path)
+    if cachefile is not None:
+        with _PROBE_LOCK:
+            record = _PROBE_MEMO.get(cachefile)
+        if record is None:
+            record = _read_json(cachefile)
+        if record is not None:
+            with _PROBE_LOCK:
+                _PROBE_MEMO[cachefile] = record
+            return record
+    try:
+        record = _probe_ffprobe(path)
+    except Exception:
+        record = _probe_ffmpeg_stderr(path)
+    record['gops'] = {}
+    if cachefile is not None:
+        _save_probe(cachefile, record)
+    return record
+
+
+def _gops_parser():
+    """
+    Return list of GOPs and function which fills it from framecrc lines
+    as they arrive, so packet list of long inputs is never kept whole.
+    """
+    state = {'tb': 1}
+    gops = []
+
+    def parse(line):
+        # E.g. "#tb 0: 1/1000"
+        m = re.match(r'#tb \d+: (\d+)/(\d+)', line)
+        if m:
+            state['tb'] = int(m.group(1)) / int(m.group(2))
+            return
+        # E.g. "0, 40, 40, 40, 1234, 0x1f2e3d4c, F=0x0"
+        m = re.match(
+            r'\d+,\s*-?\d+,\s*(-?\d+),\s*-?\d+,\s*(\d+),\s*\w+(.*)', line)
+        if not m:
+            return
+        pts = int(m.group(1)) * state['tb']
+        size, rest = int(m.group(2)), m.group(3)
+        # Flags are omitted for keyframes.
+        flags = re.search(r'F=0x([0-9A-Fa-f]+)', rest)
+        if not gops or not flags or int(flags.group(1), 16) & 1:
+            gops.append([pts, 0])
+        gops[-1][1] += size
+    return gops, parse
+
+
+def probe_gops(path, stream='0:v:0'):
+    """
+    Return start time and compressed size of each GOP of the given
+    stream. Packets are just copied so this is fast even for long
+    inputs. Memoized together with ``probe_input`` record.
+    """
+    record = probe_input(path)
+    gops = record['gops'].get(stream)
+    if gops is None:
+        gops, parse = _gops_parser()
+        _ffmpeg_output([
+            '-hide_banner', '-i', path,
+            '-map', stream, '-c', 'copy',
+            '-f', 'framecrc', '-',
+        ], on_stdout=parse)
+        record = dict(record, gops=dict(record['gops'], **{stream: gops}))
+        cachefile = _get_probe_cachefile(path)
+        if cachefile is not None:
+            _save_probe(cachefile, record)
+    return gops
+
+
+def _get_probe_stream(record, stype, spec=None):
+    """
+    Find stream selected by -vs/-as like options. Only simple absolute
+    stream numbers are supported.
+    """
+    streams = [st for st in record['streams'] if st['type'] == stype]
+    if spec is None:
+        # Prefer real video over album art.
+        for stream in streams:
+            if not stream['attached_pic']:
+                return stream
+        return streams[0] if streams else None
+    if re.match(r'\d+$', _TEXT_TYPE(spec)):
+        for stream in streams:
+            if stream['index'] == int(spec):
+                return stream
+
+
+def _get_input_info(options):
+    infile = _get_main_infile(options)
+    record = probe_input(infile)
+    induration = record['duration']
+    if induration is None:
+        induration = sys.maxsize
+    dur = _timestamp(induration)
 
     # Validate ranges.
     shift = 0
     if options.ss is not None:
         shift = _parse_time(options.ss)
         if shift > induration:
-            raise Exception(
+            raise OptionsError(
                 'Too far input seek {} '
                 '(input has only {} duration)'.format(options.ss, dur))
     if options.t is not None:
         outduration = _parse_time(options.t)
         if outduration == 0:
-            raise Exception('duration must not be zero')
+            raise OptionsError('duration must not be zero')
         if shift + outduration > induration:
-            raise Exception('end position too far in the future')
+            raise OptionsError('end position too far in the future')
     elif options.to is not None:
         endpos = _parse_time(options.to)
         outduration = endpos - shift
         if endpos > induration:
-            raise Exception(
+            raise OptionsError(
                 'End position {} too far in the future '
                 '(input has only {} duration)'.format(options.to, dur))
         if endpos <= shift:
-            raise Exception(
+            raise OptionsError(
                 'End position is less or equal than the input seek')
     else:
         outduration = induration - shift
 
-    # Metadata.
-    intitle = ''
-    title = re.search(
-        r'^\s*title\s*:\s*(.+)$', out,
-        re.MULTILINE | re.IGNORECASE)
-    if title:
-        intitle = title.group(1)
-    album = re.search(
-        r'^\s*album\s*:\s*(.+)$', out,
-        re.MULTILINE | re.IGNORECASE)
+    # Metadata. Ogg keeps tags on the streams rather than on container.
+    tagsets = [record['tags']]
+    for stype, spec in [('video', options.vs),
+                        ('audio', getattr(options, 'as'))]:
+        stream = _get_probe_stream(record, stype, spec)
+        if stream:
+            tagsets.append(stream['tags'])
+    intitle = next((t['title'] for t in tagsets if t.get('title')), '')
+    album = next((t['album'] for t in tagsets if t.get('album')), None)
     if album and intitle:
-        intitle = '{} - {}'.format(album.group(1), intitle)
+        intitle = '{} - {}'.format(album, intitle)
+
+    vstream = _get_probe_stream(
+        probe_input(options.infile), 'video', options.vs)
 
     return {
         'induration': induration,
         'outduration': outduration,
         'intitle': intitle,
+        'infps': vstream and vstream['fps'],
     }
 
 
@@ -915,15 +2059,85 @@ def _get_output_filename(options):
     return name
 
 
+_SIZESTATS_LOCK = threading.Lock()
+
+
+def _get_size_bucket(options):
+    """
+    Encodes of the same codec and similar duration and output height
+    are expected to have similar overhead.
+    """
+    codec = 'av1' if options.av1 else 'vp8' if options.vp8 else 'vp9'
+    if options.av1 and options.av1enc != 'libaom-av1':
+        # Rate control of every backend has its own drift.
+        codec += '-' + options.av1enc
+    height = options.vh
+    if height is None:
+        record = probe_input(options.infile)
+        video = _get_probe_stream(record, 'video', options.vs)
+        height = video and video['height']
+        if height and options.vw is not None and video['width']:
+            height = height * options.vw / video['width']
+    height = int(round(math.log(height, 2))) if height else 0
+    duration = int(math.log(max(1, options.outduration), 2))
+    return '{}-d{}-h{}'.format(codec, duration, height)
+
+
+def _get_size_ratio(options):
+    """
+    Return learned ratio of actual to predicted output size.
+    """
+    try:
+        bucket = _get_size_bucket(options)
+    except Exception:
+        return 1
+    stats = _read_json(os.path.join(CACHE_DIR, 'sizestats.json'), {})
+    entry = stats.get(bucket)
+    if not isinstance(entry, dict) or 'ratio' not in entry:
+        return 1
+    ratio = min(max(entry['ratio'], _SIZESTATS_MIN), _SIZESTATS_MAX)
+    if _is_verbose(options):
+        print('Applying learned size correction {:.3f} ({}, {} encodes)'
+              .format(ratio, bucket, entry.get('count')),
+              file=sys.stderr)
+    return ratio
+
+
+def _record_size(options):
+    """
+    Remember how far actual output size was from the predicted one.
+    """
+    predicted = (options.vb + options.ab) * options.outduration * 1024 / 8
+    ratio = os.path.getsize(options.outfile) / predicted
+    if not _SIZESTATS_MIN <= ratio <= _SIZESTATS_MAX:
+        return
+    try:
+        bucket = _get_size_bucket(options)
+        statsfile = os.path.join(CACHE_DIR, 'sizestats.json')
+        with _SIZESTATS_LOCK:
+            stats = _read_json(statsfile, {})
+            entry = stats.get(bucket)
+            if isinstance(entry, dict) and 'ratio' in entry:
+                entry['ratio'] += (ratio - entry['ratio']) * _SIZESTATS_WEIGHT
+                entry['count'] = entry.get('count', 0) + 1
+            else:
+                stats[bucket] = {'ratio': ratio, 'count': 1}
+            _write_json(statsfile, stats)
+    except Exception:
+        # Statistics are optional.
+        pass
+
+
 def _calc_video_bitrate(options):
     """
     Calculate video bitrate in kilobits.
     """
     limit_kbits = options.l * 8 * 1024
-    vb = limit_kbits / options.outduration - options.ab
+    ratio = 1 if options.no_size_stats else _get_size_ratio(options)
+    vb = limit_kbits / options.outduration / ratio - options.ab
     vb = int(vb * 10) / 10
     if vb < 0.001:
-        raise Exception(
+        raise OptionsError(
             '\n\nUnable to calculate video bitrate for the given limit.\n'
             'Either limit is too low, duration of the video is too long\n'
             'or audio bitrate is too high.\n'
@@ -942,15 +2156,8 @@ def _escape_ffarg(arg):
     return "'{}'".format(arg)
 
 
-def _encode(options, caps, passn):
-    firstpass = passn == 1
-    speed = max(4, options.speed) if firstpass else options.speed
-    vb = '{}k'.format(options.vb) if options.vb else '0'
-    gop = 128 if options.cover is None else 9999
-    outfile = os.devnull if firstpass else options.outfile
-
-    # Input.
-    args = ['-hide_banner']
+def _get_input_args(options):
+    args = []
     if options.ss is not None:
         args += ['-ss', options.ss]
     if options.cover is not None:
@@ -970,25 +2177,273 @@ def _encode(options, caps, passn):
     if options.ss is not None and options.ac:
         # Hack to make copied audio properly work in browsers.
         args += ['-ss', '0']
+    return args
+
+
+def _get_duration_args(options):
     if (options.t is not None or
             options.to is not None or
             options.cover is not None):
-        args += ['-t', round(options.outduration, 3)]
+        return ['-t', round(options.outduration, 3)]
+    return []
+
+
+def _get_video_stream(options):
+    vstream = 'v:0' if options.vs is None else _TEXT_TYPE(options.vs)
+    if not vstream.startswith('['):
+        vstream = '0:{}'.format(vstream)
+    return vstream
+
+
+def _get_audio_stream(options, base=0):
+    ainput = base if options.aa is None else base + 1
+    astream = getattr(options, 'as')
+    astream = 'a:0?' if astream is None else _TEXT_TYPE(astream)
+    if not astream.startswith('['):
+        astream = '{}:{}'.format(ainput, astream)
+    return astream
+
+
+def _get_audio_args(options, firstpass=False):
+    args = []
+    if options.ac:
+        # XXX: We don't actually check whether provided format is
+        # supported, it's up to the user. This will instantly fail on
+        # wrong format anyway.
+        args += ['-c:a', 'copy']
+    elif firstpass or options.an:
+        args += ['-an']
+    else:
+        args += ['-ac', '2']
+        if options.opus:
+            args += ['-c:a', 'libopus', '-b:a', '{}k'.format(options.ab)]
+        else:
+            args += ['-c:a', 'libvorbis', '-q:a', options.aq]
+        if options.af is not None:
+            args += ['-af', options.af]
+    return args
+
+
+def _get_metadata_args(options):
+    args = []
+    if options.mn:
+        args += ['-map_metadata', '-1']
+    else:
+        if options.mt is not None:
+            title = options.mt
+            if title is True:
+                title = os.path.basename(options.outfile)
+                title = os.path.splitext(title)[0]
+            args += ['-metadata', 'title={}'.format(title)]
+        elif options.cover is not None and options.intitle:
+            args += ['-metadata', 'title={}'.format(options.intitle)]
+        if options.mc:
+            ctime = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+            args += ['-metadata', 'creation_time={}'.format(ctime)]
+    return args
+
+
+def _get_video_filters(options):
+    vfilters = []
+    if options.vfi is not None:
+        vfilters += [options.vfi]
+    if options.vw is not None or options.vh is not None:
+        scale = 'scale='
+        scale += '-1' if options.vw is None else _TEXT_TYPE(options.vw)
+        scale += ':'
+        scale += '-1' if options.vh is None else _TEXT_TYPE(options.vh)
+        vfilters += [scale]
+    if options.sa is not None:
+        sub_delay = 0
+        if options.ss is not None:
+            sub_delay += _parse_time(options.ss)
+        if options.sd is not None:
+            sub_delay += options.sd
+        if sub_delay:
+            vfilters += ['setpts=PTS+{}/TB'.format(round(sub_delay, 3))]
+        subtitles = 'subtitles='
+        sub_file = options.infile if options.sa is True else options.sa
+        subtitles += _escape_ffarg(sub_file)
+        if options.si is not None:
+            subtitles += ':si={}'.format(options.si)
+        if options.sf is not None:
+            subtitles += ':force_style={}'.format(_escape_ffarg(options.sf))
+        vfilters += [subtitles]
+        if sub_delay:
+            vfilters += ['setpts=PTS-STARTPTS']
+    if options.vf is not None:
+        vfilters += [options.vf]
+    return vfilters
+
+
+def _apply_crop(vfilters, width, height):
+    # E.g. "crop=640:360:0:60", last one wins.
+    for m in re.finditer(r'\bcrop=(?:w=)?(\d+):(?:h=)?(\d+)', vfilters or ''):
+        width, height = int(m.group(1)), int(m.group(2))
+    return width, height
+
+
+def _get_output_size(options):
+    """
+    Guess output resolution from the probed input, crop filters and
+    -vw/-vh. Return ``(None, None)`` if it's unknown.
+    """
+    try:
+        record = probe_input(options.infile)
+    except Exception:
+        return None, None
+    video = _get_probe_stream(record, 'video', options.vs)
+    if not video or not video['width'] or not video['height']:
+        return None, None
+    width, height = _apply_crop(options.vfi, video['width'], video['height'])
+    vw = options.vw if options.vw and options.vw > 0 else None
+    vh = options.vh if options.vh and options.vh > 0 else None
+    if vw and vh:
+        width, height = vw, vh
+    elif vw:
+        width, height = vw, height * vw / width
+    elif vh:
+        width, height = width * vh / height, vh
+    return _apply_crop(options.vf, int(width), int(height))
+
+
+def plan_tiles(codec, width, height, cpus, row_mt=True, tile_rows=True):
+    """
+    Pick tiling and number of encoder threads for the given output
+    resolution and CPU budget. Return dict with log2 ``tile_columns``
+    and ``tile_rows``, number of VP8 token partitions (``slices``) and
+    ``threads``; None means encoder default.
+
+    Tiles are at least 256 pixels wide, the minimum of VP9. Encoder
+    threads beyond the number of tiles (twice that with row-mt) would
+    only contend for the CPU. VP9 gets the same tiling as recommended by
+    libvpx for adaptive streaming, AV1 also splits tall frames into rows
+    once there are not enough columns to fill the budget. If resolution
+    is unknown AV1 gets enough columns to saturate the budget.
+    """
+    def log2floor(value):
+        return int(math.log(value, 2)) if value >= 2 else 0
+
+    plan = {
+        'tile_columns': None,
+        'tile_rows': None,
+        'slices': None,
+        'threads': cpus,
+    }
+    want = int(math.ceil(math.log(cpus, 2))) if cpus > 1 else 0
+    if not width or not height:
+        if codec == 'av1':
+            # Tiles of AV1 aren't constrained by width that much.
+            plan['tile_columns'] = min(6, want)
+        return plan
+    if codec == 'vp8':
+        # Macroblock rows are encoded in parallel with a lag.
+        threads = max(1, min(cpus, (height + 15) // 16 // 4))
+        plan['threads'] = threads
+        plan['slices'] = 2 ** min(3, log2floor(threads))
+        return plan
+    maxcols = min(6, log2floor(width / 256))
+    if codec == 'vp9':
+        cols, rows = maxcols, 0
+    else:
+        cols = min(maxcols, want)
+        rows = min(6, log2floor(height / 256), want - cols) \
+            if tile_rows else 0
+    plan['tile_columns'] = cols
+    plan['tile_rows'] = rows
+    per_tile = 2 if row_mt else 1
+    plan['threads'] = max(1, min(cpus, 2 ** (cols + rows) * per_tile))
+    return plan
+
+
+def _get_tile_plan(options, caps):
+    codec = 'av1' if options.av1 else 'vp8' if options.vp8 else 'vp9'
+    row_mt = caps.get('row_mt')
+    tile_rows = True
+    if options.av1enc == 'libaom-av1':
+        row_mt = caps.get('aom_row_mt')
+        tile_rows = caps.get('aom_tile_rows')
+    elif options.av1:
+        # rav1e always encodes tiles in parallel, SVT-AV1 ignores plan.
+        row_mt = False
+    width, height = _get_output_size(options)
+    plan = plan_tiles(codec, width, height, options.threads, row_mt,
+                      tile_rows=tile_rows)
+    return plan
+
+
+def _get_av1_args(options, caps, speed, plan):
+    """
+    Map speed [0..8] and tiling onto the selected AV1 encoder. Quality
+    and bitrate options are common.
+    """
+    if options.av1enc == 'libsvtav1':
+        # Presets are in [0..13] range, tiling is internal.
+        return ['-c:v', 'libsvtav1', '-preset', int(round(speed * 1.5))]
+    if options.av1enc == 'librav1e':
+        args = ['-c:v', 'librav1e', '-speed', int(round(speed * 10 / 8))]
+    else:
+        args = [
+            '-c:v', 'libaom-av1', '-cpu-used', speed,
+            '-strict', 'experimental',
+        ]
+        if caps.get('aom_row_mt'):
+            args += ['-row-mt', '1']
+    columns, rows = plan['tile_columns'], plan['tile_rows']
+    if options.av1enc == 'librav1e':
+        # rav1e takes number of tiles rather than its log2.
+        columns = None if columns is None else 2 ** columns
+        rows = rows and 2 ** rows
+    if columns is not None:
+        args += ['-tile-columns', columns]
+    if rows:
+        args += ['-tile-rows', rows]
+    return args
+
+
+def _get_encode_args(options, caps, passn):
+    firstpass = passn == 1
+    speed = max(4, options.speed) if firstpass else options.speed
+    vb = '{}k'.format(options.vb) if options.vb else '0'
+    gop = 128 if options.cover is None else 9999
+    outfile = os.devnull if firstpass else options.outfile
+
+    prefiltered = getattr(options, 'prefiltered', None)
+    audiofile = None if firstpass else getattr(options, 'audiofile', None)
+    vstream = _get_video_stream(options)
+
+    # Input.
+    args = ['-hide_banner']
+    if prefiltered:
+        # Video is read from the intermediate, audio from the original
+        # inputs.
+        args += ['-i', prefiltered]
+        vstream = '0:v:0'
+    args += _get_input_args(options)
+    if audiofile:
+        # Audio was encoded concurrently with the first pass.
+        ainput = args.count('-i')
+        args += ['-i', audiofile]
+    if firstpass and options.progress is not None:
+        # libvpx doesn't output any frames in first pass so track the
+        # decoded ones with dummy output instead. FFmpeg reports the
+        # progress of the first output.
+        args += _get_duration_args(options)
+        args += ['-map', vstream, '-f', 'null', '-']
+    args += _get_duration_args(options)
 
     # Streams.
     if (options.vs is not None or
             getattr(options, 'as') is not None or
-            options.aa is not None):
-        vstream = 'v:0' if options.vs is None else _TEXT_TYPE(options.vs)
-        if not vstream.startswith('['):
-            vstream = '0:{}'.format(vstream)
+            options.aa is not None or
+            prefiltered or
+            audiofile):
         args += ['-map', vstream]
-        ainput = 0 if options.aa is None else 1
-        astream = getattr(options, 'as')
-        astream = 'a:0?' if astream is None else _TEXT_TYPE(astream)
-        if not astream.startswith('['):
-            astream = '{}:{}'.format(ainput, astream)
-        args += ['-map', astream]
+        if audiofile:
+            args += ['-map', '{}:a:0'.format(ainput)]
+        else:
+            args += ['-map', _get_audio_stream(
+                options, 1 if prefiltered else 0)]
 
     # Passes.
     if passn:
@@ -997,44 +2452,47 @@ def _encode(options, caps, passn):
         args += ['-pass', passn, '-passlogfile', passlogfile]
 
     # Logging.
-    if options.verbose:
-        args += ['-v', 'verbose']
+    args += _get_log_args(options)
 
     # Video.
+    plan = _get_tile_plan(options, caps)
     if options.av1:
-        # In AV1 tile-columns seems to be not constrained by video
-        # width. Or at least not that much compared to VP9.
-        tile_cols_approx = math.log(options.threads, 2)
-        # Make sure we saturated all available threads.
-        tile_cols = int(math.ceil(tile_cols_approx))
-        args += [
-            '-c:v', 'libaom-av1', '-cpu-used', speed,
-            '-strict', 'experimental',
-            '-tile-columns', tile_cols,
-        ]
+        args += _get_av1_args(options, caps, speed, plan)
     elif options.vp8:
         args += ['-c:v', 'libvpx', '-speed', speed]
+        if plan['slices'] is not None:
+            # Mapped to token partitions by FFmpeg.
+            args += ['-slices', plan['slices']]
     else:
-        # tile-columns=6 by default but won't harm. See also:
+        # Encoder clamps tile-columns by video width. See also:
         # <http://permalink.gmane.org/gmane.comp.multimedia.webm.devel/2339>.
         # frame-parallel should be disabled, see:
         # <http://permalink.gmane.org/gmane.comp.multimedia.webm.devel/2359>.
         args += [
             '-c:v', 'libvpx-vp9', '-speed', speed,
-            '-tile-columns', '6', '-frame-parallel', '0',
+            '-tile-columns', 6 if plan['tile_columns'] is None
+            else plan['tile_columns'],
+            '-frame-parallel', '0',
         ]
         if caps['row_mt']:
             args += ['-row-mt', '1']
+    args += ['-b:v', vb, '-threads', plan['threads']]
+    if not options.av1 or options.av1enc == 'libaom-av1':
+        args += ['-auto-alt-ref', '1', '-lag-in-frames', '25']
     args += [
-        '-b:v', vb, '-threads', options.threads,
-        '-auto-alt-ref', '1', '-lag-in-frames', '25', '-g', gop,
+        '-g', gop,
         # Using other subsamplings require profile>0 which support
         # across various decoders is still poor. User can still redefine
         # this via ``-fo``.
         '-pix_fmt', 'yuv420p',
     ]
+    # rav1e quantizers are in [0..255] range.
+    qscale = 255 / 63 if options.av1 and options.av1enc == 'librav1e' else 1
     if options.crf is not None:
-        args += ['-crf', options.crf]
+        if qscale == 1:
+            args += ['-crf', options.crf]
+        else:
+            args += ['-qp', int(round(options.crf * qscale))]
         if options.vp9 and options.crf == 0:
             args += ['-lossless', '1']
     if options.qmin is not None:
@@ -1043,54 +2501,15 @@ def _encode(options, caps, passn):
         args += ['-qmax', options.qmax]
 
     # Video filters.
-    vfilters = []
-    if options.vfi is not None:
-        vfilters += [options.vfi]
-    if options.vw is not None or options.vh is not None:
-        scale = 'scale='
-        scale += '-1' if options.vw is None else _TEXT_TYPE(options.vw)
-        scale += ':'
-        scale += '-1' if options.vh is None else _TEXT_TYPE(options.vh)
-        vfilters += [scale]
-    if options.sa is not None:
-        sub_delay = 0
-        if options.ss is not None:
-            sub_delay += _parse_time(options.ss)
-        if options.sd is not None:
-            sub_delay += options.sd
-        if sub_delay:
-            vfilters += ['setpts=PTS+{}/TB'.format(round(sub_delay, 3))]
-        subtitles = 'subtitles='
-        sub_file = options.infile if options.sa is True else options.sa
-        subtitles += _escape_ffarg(sub_file)
-        if options.si is not None:
-            subtitles += ':si={}'.format(options.si)
-        if options.sf is not None:
-            subtitles += ':force_style={}'.format(_escape_ffarg(options.sf))
-        vfilters += [subtitles]
-        if sub_delay:
-            vfilters += ['setpts=PTS-STARTPTS']
-    if options.vf is not None:
-        vfilters += [options.vf]
+    vfilters = [] if prefiltered else _get_video_filters(options)
     if vfilters:
         args += ['-vf', ','.join(vfilters)]
 
     # Audio.
-    if options.ac:
-        # XXX: We don't actually check whether provided format is
-        # supported, it's up to the user. This will instantly fail on
-        # wrong format anyway.
+    if audiofile:
         args += ['-c:a', 'copy']
-    elif firstpass or options.an:
-        args += ['-an']
     else:
-        args += ['-ac', '2']
-        if options.opus:
-            args += ['-c:a', 'libopus', '-b:a', '{}k'.format(options.ab)]
-        else:
-            args += ['-c:a', 'libvorbis', '-q:a', options.aq]
-        if options.af is not None:
-            args += ['-af', options.af]
+        args += _get_audio_args(options, firstpass)
 
     # Subtitles.
     # Avoid embedded subs because they are not supported in browsers.
@@ -1098,20 +2517,7 @@ def _encode(options, caps, passn):
 
     # Metadata.
     if not firstpass:
-        if options.mn:
-            args += ['-map_metadata', '-1']
-        else:
-            if options.mt is not None:
-                title = options.mt
-                if title is True:
-                    title = os.path.basename(options.outfile)
-                    title = os.path.splitext(title)[0]
-                args += ['-metadata', 'title={}'.format(title)]
-            elif options.cover is not None and options.intitle:
-                args += ['-metadata', 'title={}'.format(options.intitle)]
-            if options.mc:
-                ctime = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
-                args += ['-metadata', 'creation_time={}'.format(ctime)]
+        args += _get_metadata_args(options)
 
     # Output.
     args += ['-y', '-f', 'webm']
@@ -1121,28 +2527,1412 @@ def _encode(options, caps, passn):
         args += shlex.split(options.fo)
 
     args += [outfile]
-    args = [_TEXT_TYPE(arg) for arg in args]
-    _ffmpeg(args, debug=True)
+    return [_TEXT_TYPE(arg) for arg in args]
+
+
+def _get_log_args(options):
+    if options.verbose:
+        return ['-v', 'verbose']
+    elif options.quiet:
+        return ['-v', 'error', '-nostats']
+    else:
+        return []
+
+
+_PROGRESS_STREAMS = {}
+_PROGRESS_LOCK = threading.Lock()
+
+
+def _emit_progress(target, event):
+    line = json.dumps(event, sort_keys=True).encode('utf-8') + b'\n'
+    with _PROGRESS_LOCK:
+        fh = _PROGRESS_STREAMS.get(target)
+        if fh is None:
+            if re.match(r'\d+$', target):
+                fh = os.fdopen(int(target), 'wb')
+            else:
+                fh = open(target, 'ab')
+            _PROGRESS_STREAMS[target] = fh
+        fh.write(line)
+        fh.flush()
+
+
+def _parse_progress_value(value, conv=float):
+    # FFmpeg reports "N/A" when value is not known yet.
+    try:
+        return conv(value.rstrip('x'))
+    except ValueError:
+        return None
+
+
+def _get_progress_callback(options, passn):
+    hook = getattr(options, 'progress_hook', None)
+    if options.progress is None and hook is None:
+        return None
+    start = time.time()
+
+    def callback(block):
+        get = _parse_progress_value
+        elapsed = time.time() - start
+        frame = get(block.get('frame', 'N/A'), int)
+        out_time = get(block.get('out_time_us', 'N/A'), int)
+        if out_time is not None:
+            out_time = max(0, out_time / 1000000)
+        elif frame and options.infps:
+            # Dummy output of the first pass doesn't report time.
+            out_time = frame / options.infps
+        speed = get(block.get('speed', 'N/A'))
+        done = block.get('progress') == 'end'
+        percent = eta = None
+        if done:
+            percent, eta = 100, 0
+        elif out_time is not None:
+            percent = min(100, out_time / options.outduration * 100)
+            remaining = max(0, options.outduration - out_time)
+            if speed:
+                eta = remaining / speed
+            elif out_time:
+                eta = elapsed * remaining / out_time
+        event = {
+            'event': 'progress',
+            'outfile': options.outfile,
+            'pass': passn,
+            'chunk': getattr(options, 'chunk', None),
+            'frame': frame,
+            'fps': get(block.get('fps', 'N/A')),
+            'out_time': out_time,
+            'total_size': get(block.get('total_size', 'N/A'), int),
+            'speed': speed,
+            'percent': percent,
+            'elapsed': elapsed,
+            'eta': eta,
+            'done': done,
+        }
+        if hook is not None:
+            hook(event)
+        if options.progress is not None:
+            _emit_progress(options.progress, event)
+    return callback
+
+
+def _encode(options, caps, passn):
+    args = _get_encode_args(options, caps, passn)
+    progress = _get_progress_callback(options, passn)
+    _ffmpeg(args, debug=not options.quiet, progress=progress,
+            **_supervise(options))
+    if passn == 1 and progress is not None:
+        # FFmpeg names the log by global index of the output stream,
+        # dummy output of the first pass shifted it.
+        getattr(os, 'replace', os.rename)(
+            options.logfile[:-6] + '-1.log', options.logfile)
+
+
+def _prune_cache(dirname, maxsize):
+    """
+    Remove least recently used files until directory fits the size.
+    """
+    try:
+        entries = []
+        for name in os.listdir(dirname):
+            path = os.path.join(dirname, name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+    except OSError:
+        return
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= maxsize:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            # Removed by concurrent process.
+            pass
+        total -= size
+
+
+def _get_passlog_key(options, caps):
+    """
+    First pass statistics depend only on the input and the first pass
+    arguments, so they can be shared between encodes which differ in
+    bitrate, audio or metadata.
+    """
+    noprogress = copy.copy(options)
+    noprogress.progress = None
+    # Intermediate is lossless so statistics are the same.
+    noprogress.prefiltered = None
+    args = _get_encode_args(noprogress, caps, passn=1)
+    key = [caps['ffmpegv']]
+    it = iter(args)
+    for arg in it:
+        if arg in ('-passlogfile', '-b:v', '-threads', '-v'):
+            next(it)
+        elif arg == '-i':
+            key += [arg, _file_identity(next(it))]
+        elif arg != '-nostats':
+            key += [arg]
+    if isinstance(options.sa, _TEXT_TYPE):
+        key += [_file_identity(options.sa)]
+    key = json.dumps(key).encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+
+def _first_pass(options, caps):
+    """
+    Run first pass or reuse statistics of the previous run.
+    """
+    cachefile = None
+    if not options.no_passlog_cache:
+        try:
+            key = _get_passlog_key(options, caps)
+        except Exception:
+            # E.g. input is URL.
+            pass
+        else:
+            cachedir = os.path.join(CACHE_DIR, 'passlogs')
+            cachefile = os.path.join(cachedir, key + '-0.log')
+    if cachefile is not None and os.path.exists(cachefile):
+        try:
+            shutil.copyfile(cachefile, options.logfile)
+            # Mark as recently used.
+            os.utime(cachefile, None)
+        except Exception:
+            pass
+        else:
+            if not options.quiet:
+                print('Reusing first pass statistics from {}'.format(
+                          cachefile),
+                      file=sys.stderr)
+            return
+    _encode(options, caps, passn=1)
+    if cachefile is not None and os.path.getsize(options.logfile):
+        try:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            fh, tmppath = tempfile.mkstemp(suffix='.tmp', dir=cachedir)
+            os.close(fh)
+            shutil.copyfile(options.logfile, tmppath)
+            getattr(os, 'replace', os.rename)(tmppath, cachefile)
+            _prune_cache(cachedir, _PASSLOG_CACHE_SIZE)
+        except Exception:
+            # Cache is optional.
+            pass
+
+
+def _has_audio(options):
+    if getattr(options, 'as') is not None:
+        return True
+    try:
+        record = probe_input(options.aa or options.infile)
+    except Exception:
+        return False
+    return any(st['type'] == 'audio' for st in record['streams'])
+
+
+def _encode_audio(options):
+    """
+    Encode audio track alone so it can be muxed with ``-c:a copy``.
+    """
+    path = _mktemp(options, '.webm')
+    args = ['-hide_banner']
+    args += _get_input_args(options)
+    args += _get_duration_args(options)
+    args += ['-map', _get_audio_stream(options)]
+    args += ['-v', 'verbose'] if options.verbose else ['-v', 'error']
+    args += ['-nostats', '-vn', '-sn', '-dn']
+    args += _get_audio_args(options)
+    args += ['-y', '-f', 'webm', path]
+    _ffmpeg([_TEXT_TYPE(arg) for arg in args], debug=not options.quiet,
+            **_supervise(options))
+    return path
+
+
+def _first_pass_with_audio(options, caps):
+    """
+    Run first pass and audio encode at the same time, taking audio off
+    the critical path of the last pass.
+    """
+    if options.an or options.ac or not _has_audio(options):
+        _first_pass(options, caps)
+        return
+    result = {}
+
+    def run():
+        try:
+            result['path'] = _encode_audio(options)
+        except Exception as exc:
+            result['error'] = exc
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        _first_pass(options, caps)
+    finally:
+        thread.join()
+    if 'error' in result:
+        raise result['error']
+    options.audiofile = result['path']
+
+
+def _content_hash(path):
+    """
+    Hash of the whole file content, renamed or mirrored inputs get the
+    same hash. Memoized on disk, keyed by path, size, mtime and inode
+    of the file, so it's read again only once changed.
+    """
+    identity = _file_identity(path)
+    key = hashlib.sha1(json.dumps(identity).encode('utf-8')).hexdigest()
+    cachefile = os.path.join(CACHE_DIR, 'hashes', key + '.json')
+    cached = _read_json(cachefile)
+    if cached is not None:
+        return cached
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(_HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    digest = digest.hexdigest()
+    if _file_identity(path) == identity:
+        # Don't remember hash of the file which was changed meanwhile.
+        try:
+            _write_json(cachefile, digest)
+            _prune_cache(os.path.dirname(cachefile), _HASH_CACHE_SIZE)
+        except Exception:
+            # Cache is optional.
+            pass
+    return digest
+
+
+def _get_output_cache_key(options, caps):
+    keyopts = copy.copy(options)
+    keyopts.progress = None
+    keyopts.logfile = '-0.log'
+    passn = 0 if options.singlepass else 2
+    args = _get_encode_args(keyopts, caps, passn)
+    key = [caps['ffmpegv']]
+    it = iter(args[:-1])
+    for arg in it:
+        if arg in ('-passlogfile', '-threads', '-v'):
+            next(it)
+        elif arg == '-i':
+            key += [arg, _content_hash(next(it))]
+        elif arg != '-nostats':
+            key += [arg]
+    if isinstance(options.sa, _TEXT_TYPE):
+        key += [_content_hash(options.sa)]
+    # Options which change the way encode is done. Speed of the
+    # deadline encodes is picked at run time so the budget stands for it.
+    key += [options.chunks, options.smartcut, options.noremux,
+            options.la, options.lt, options.autocrf,
+            options.deadline_seconds]
+    key = json.dumps(key).encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+
+def _find_cached_output(cachedir, key):
+    """
+    Cached outputs are named "<key>.<size>.webm" so entries which were
+    modified through hardlinked output can be detected.
+    """
+    try:
+        names = os.listdir(cachedir)
+    except OSError:
+        return None
+    for name in names:
+        parts = name.split('.')
+        if len(parts) == 3 and parts[0] == key and parts[2] == 'webm':
+            path = os.path.join(cachedir, name)
+            try:
+                if os.path.getsize(path) == int(parts[1]):
+                    return path
+                os.remove(path)
+            except (OSError, ValueError):
+                pass
+    return None
+
+
+def _reuse_output(options, caps):
+    """
+    Link or copy output of the identical previous encode into place.
+    Return cache key to store the output under or None if output can't
+    be cached.
+    """
+    if options.mc:
+        # Creation time makes every output unique.
+        return None
+    try:
+        key = _get_output_cache_key(options, caps)
+    except Exception:
+        # E.g. input is URL.
+        return None
+    cachefile = _find_cached_output(os.path.join(CACHE_DIR, 'outputs'), key)
+    if cachefile is None:
+        try:
+            if os.stat(options.outfile).st_nlink > 1:
+                # Probably linked to other cache entry, don't overwrite
+                # it in place.
+                os.remove(options.outfile)
+        except OSError:
+            pass
+        return key
+    try:
+        if os.path.exists(options.outfile):
+            os.remove(options.outfile)
+        try:
+            os.link(cachefile, options.outfile)
+        except (AttributeError, OSError):
+            shutil.copyfile(cachefile, options.outfile)
+        # Mark as recently used.
+        os.utime(cachefile, None)
+    except Exception:
+        return key
+    options.cached = True
+    if not options.quiet:
+        print('Reusing output from {}'.format(cachefile), file=sys.stderr)
+    return key
+
+
+def _store_output(options, key):
+    cachedir = os.path.join(CACHE_DIR, 'outputs')
+    try:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        size = os.path.getsize(options.outfile)
+        cachefile = os.path.join(cachedir, '{}.{}.webm'.format(key, size))
+        _copy_atomic(options.outfile, cachefile)
+        _prune_cache(cachedir, int(options.output_cache * 1024 * 1024))
+    except Exception:
+        # Cache is optional.
+        pass
+
+
+def _mktemp(options, suffix, dirname=None):
+    """
+    Create temporal file which will be removed by ``cleanup``.
+    """
+    fh, path = tempfile.mkstemp(suffix=suffix, dir=dirname)
+    os.close(fh)
+    options.__dict__.setdefault('tmpfiles', []).append(path)
+    return path
+
+
+def _get_copy_info(options):
+    """
+    Check whether video stream may be copied to the output as is: it
+    must already be in requested codec (VP9 default also accepts AV1)
+    and yuv420p and no filters may be applied. Audio may be copied too
+    if it's in requested codec and doesn't need downmix. Return None or
+    probed video stream with its GOPs and audio information.
+    """
+    if (options.cover is not None or
+            options.sa is not None or
+            options.vf is not None or
+            options.vfi is not None or
+            options.vw is not None or
+            options.vh is not None or
+            options.fo is not None or
+            options.foi is not None or
+            options.foi2 is not None or
+            options.qmin is not None or
+            options.qmax is not None or
+            options.autocrf):
+        return None
+    vspec = _get_video_stream(options)
+    if vspec.startswith('['):
+        return None
+    record = probe_input(options.infile)
+    video = _get_probe_stream(record, 'video', options.vs)
+    codecs = ['av1'] if options.av1 else ['vp8'] if options.vp8 else \
+        ['vp9', 'av1']
+    if (video is None or
+            video['attached_pic'] or
+            video['codec'] not in codecs or
+            video['pix_fmt'] != 'yuv420p'):
+        return None
+
+    # Bytes per second.
+    abitrate = options.ab * 1000 / 8
+    acopy = True
+    if not options.an and not options.ac:
+        arecord = record if options.aa is None else probe_input(options.aa)
+        audio = _get_probe_stream(arecord, 'audio', getattr(options, 'as'))
+        if audio is None:
+            if getattr(options, 'as') is not None:
+                return None
+            abitrate = 0
+        elif (options.af is not None or
+                audio['codec'] != ('opus' if options.opus else 'vorbis') or
+                (audio['channels'] or 3) > 2):
+            acopy = False
+        elif audio['bit_rate']:
+            abitrate = audio['bit_rate'] / 8
+
+    gops = probe_gops(options.infile, vspec)
+    if not gops:
+        return None
+    start = gops[0][0]
+    return {
+        'vspec': vspec,
+        'video': video,
+        # Keyframe positions relative to the input start and GOP sizes.
+        'gops': [(pts - start, size) for pts, size in gops],
+        'abitrate': abitrate,
+        'acopy': acopy,
+    }
+
+
+def _fits_budget(options, info):
+    shift = 0 if options.ss is None else _parse_time(options.ss)
+    end = shift + options.outduration
+    # GOP which contains the start position is counted too.
+    first = max([pts for pts, _ in info['gops'] if pts <= shift] or [0])
+    vsize = sum(size for pts, size in info['gops'] if first <= pts < end)
+    if options.l is not None:
+        size = vsize + info['abitrate'] * options.outduration
+        return size <= options.l * 1024 * 1024
+    elif options.vb:
+        return vsize * 8 / options.outduration <= options.vb * 1000
+    return True
+
+
+def _get_remux_args(options):
+    """
+    Return FFmpeg arguments to produce the output by stream copy or None
+    if input has to be re-encoded. Besides stream copy constraints, seek
+    must point to keyframe and size must fit the limit/bitrate.
+    """
+    if options.noremux or (options.l is None and not options.vb):
+        return None
+    info = _get_copy_info(options)
+    if info is None or not info['acopy']:
+        return None
+    video, vspec = info['video'], info['vspec']
+    shift = 0 if options.ss is None else _parse_time(options.ss)
+    if shift and not any(abs(pts - shift) < 0.002 for pts, _ in info['gops']):
+        return None
+    if not _fits_budget(options, info):
+        return None
+
+    remux = copy.copy(options)
+    if shift:
+        # Seek into the first frame of GOP, otherwise demuxer may pick
+        # the previous keyframe because of timestamp rounding.
+        remux.ss = _TEXT_TYPE(round(shift + 0.5 / (video['fps'] or 1000), 6))
+    args = ['-hide_banner']
+    args += _get_input_args(remux)
+    args += _get_duration_args(options)
+    args += ['-map', vspec]
+    if not options.an:
+        args += ['-map', _get_audio_stream(options)]
+    args += _get_log_args(options)
+    args += ['-c', 'copy', '-sn', '-dn']
+    if options.an:
+        args += ['-an']
+    args += _get_metadata_args(options)
+    args += ['-y', '-f', 'webm', options.outfile]
+    return [_TEXT_TYPE(arg) for arg in args]
+
+
+def _remux(options):
+    """
+    Try to produce the output without re-encoding.
+    """
+    try:
+        args = _get_remux_args(options)
+    except Exception:
+        # E.g. unusual stream specifiers, just encode.
+        return False
+    if args is None:
+        return False
+    _start_phase(options, 'remux')
+    _ffmpeg(args, debug=not options.quiet, **_supervise(options))
+    if options.l is not None and \
+            os.path.getsize(options.outfile) > options.l * 1024 * 1024:
+        # Container overhead was underestimated.
+        os.remove(options.outfile)
+        return False
+    options.remuxed = True
+    return True
+
+
+def _smartcut(options, caps):
+    """
+    Re-encode only the partial GOP at the start of the fragment and copy
+    the rest. Frames of VPx/AV1 streams never reference the future ones
+    in decode order, so stream may be cut after any frame and only the
+    start position has to be at keyframe.
+    """
+    try:
+        info = _get_copy_info(options)
+    except Exception:
+        return False
+    if info is None or not _fits_budget(options, info):
+        return False
+    shift = 0 if options.ss is None else _parse_time(options.ss)
+    end = shift + options.outduration
+    keyframes = [pts for pts, _ in info['gops'] if pts > shift - 0.002]
+    if not keyframes or keyframes[0] >= end:
+        # Fragment lies inside single GOP, nothing to copy.
+        return False
+    keyframe = keyframes[0]
+    half_frame = 0.5 / (info['video']['fps'] or 1000)
+    _start_phase(options, 'smartcut')
+
+    parts = []
+    if keyframe - shift >= 0.002:
+        head = copy.copy(options)
+        head.singlepass = True
+        head.to = None
+        # Exclude the keyframe itself.
+        head.t = head.outduration = \
+            math.floor((keyframe - shift) * 1000 - 0.5) / 1000
+        head.av1 = info['video']['codec'] == 'av1'
+        head.vp8 = info['video']['codec'] == 'vp8'
+        head.vp9 = info['video']['codec'] == 'vp9'
+        if head.av1 and head.av1enc is None:
+            head.av1enc = _get_av1_encoder(None, caps)
+        if (head.av1, head.vp8) != (options.av1, options.vp8):
+            # -speed is meant for the requested codec.
+            head.speed = _get_default_speed(head)
+        # Keep quality of the source GOP.
+        gop = [g for g in info['gops'] if g[0] <= shift][-1:]
+        nextgop = [pts for pts, _ in info['gops'] if pts > gop[0][0]] \
+            if gop else []
+        if gop and nextgop:
+            head.vb = round(gop[0][1] * 8 / (nextgop[0] - gop[0][0]) / 1000, 1)
+        head.an = True
+        head.ac = False
+        head.aa = None
+        setattr(head, 'as', None)
+        head.af = None
+        head.progress = None
+        head.outfile = _mktemp(options, '.webm')
+        _encode(head, caps, passn=0)
+        parts.append(head)
+
+    rest = copy.copy(options)
+    rest.outfile = _mktemp(options, '.webm')
+    args = ['-hide_banner', '-ss', round(keyframe + half_frame, 6)]
+    args += ['-i', options.infile]
+    args += ['-t', round(end - keyframe, 3)]
+    args += ['-map', info['vspec']]
+    args += _get_log_args(options)
+    args += ['-c', 'copy', '-an', '-sn', '-dn']
+    args += ['-y', '-f', 'webm', rest.outfile]
+    _ffmpeg([_TEXT_TYPE(arg) for arg in args], debug=not options.quiet,
+            **_supervise(options))
+    parts.append(rest)
+
+    audio = copy.copy(options)
+    if info['acopy'] and not options.an:
+        audio.ac = True
+    _concat_chunks(audio, parts)
+    if options.l is not None and \
+            os.path.getsize(options.outfile) > options.l * 1024 * 1024:
+        # Copied part or container overhead was underestimated.
+        os.remove(options.outfile)
+        return False
+    options.smartcut_head = parts[0].outduration if len(parts) > 1 else 0
+    return True
+
+
+def _get_spool_dir(size):
+    """
+    Prefer memory-backed filesystem for the intermediate file of the
+    given estimated size if it comfortably fits there.
+    """
+    if size is None or not hasattr(os, 'statvfs'):
+        return None
+    try:
+        st = os.statvfs('/dev/shm')
+    except OSError:
+        return None
+    if not os.access('/dev/shm', os.W_OK):
+        return None
+    if size > st.f_bavail * st.f_frsize / 2:
+        return None
+    return '/dev/shm'
+
+
+def _get_prefilter_size(options):
+    width, height = _get_output_size(options)
+    if not width or not height or not options.infps:
+        return None
+    return int(width * height * _PREFILTER_BPP *
+               options.infps * options.outduration)
+
+
+def _prefilter(options, caps):
+    """
+    Decode, cut and filter the video once into lossless intermediate
+    which is then used as video input of both passes.
+    """
+    size = _get_prefilter_size(options)
+    path = _mktemp(options, '.nut', _get_spool_dir(size))
+    if _is_verbose(options):
+        print('Prefilter: estimated {} B intermediate in {}'.format(
+                  size, os.path.dirname(path)),
+              file=sys.stderr)
+    args = ['-hide_banner']
+    args += _get_input_args(options)
+    args += _get_duration_args(options)
+    args += ['-map', _get_video_stream(options)]
+    args += _get_log_args(options)
+    vfilters = _get_video_filters(options)
+    if vfilters:
+        args += ['-vf', ','.join(vfilters)]
+    # Intra-only FFV1 with slices is both fast to encode and to decode.
+    args += [
+        '-c:v', 'ffv1', '-level', '3', '-g', '1', '-slicecrc', '0',
+        '-slices', 4 if options.threads > 1 else 1,
+        '-threads', options.threads,
+        '-an', '-sn', '-dn', '-y', '-f', 'nut', path,
+    ]
+    _ffmpeg([_TEXT_TYPE(arg) for arg in args], debug=not options.quiet,
+            **_supervise(options))
+    options.prefiltered = path
+
+
+def _is_still_cover(options):
+    """
+    Check whether cover can be encoded once and stretched to the audio
+    duration instead of being looped through the encoder.
+    """
+    if (options.cover is not True or
+            options.foi is not None or
+            options.foi2 is not None or
+            options.la or
+            options.outduration <= 2):
+        return False
+    try:
+        record = probe_input(options.infile)
+    except Exception:
+        return False
+    videos = [st for st in record['streams'] if st['type'] == 'video']
+    return len(videos) == 1 and videos[0]['codec'] in _STILL_CODECS
+
+
+_COVER_LOCKS = {}
+
+
+def _get_cover_lock(key):
+    with _PROBE_LOCK:
+        return _COVER_LOCKS.setdefault(key, threading.Lock())
+
+
+def _encode_still(options, caps):
+    """
+    Encode two frames of cover image with one second interval. Result is
+    cached so tracks of the same album share it.
+    """
+    still = copy.copy(options)
+    still.singlepass = True
+    still.outduration = 2
+    still.ss = still.aa = still.progress = None
+    still.an = still.mn = True
+    still.ac = False
+    still.la = 0
+    # Quality doesn't depend on the track length so the whole album
+    # shares the cover. VP8 can't do pure quality mode.
+    if options.crf is None or options.autocrf:
+        still.crf = _COVER_CRF
+        still.qmin = still.qmax = None
+    still.vb = _COVER_VB if options.vp8 else 0
+    still.outfile = _mktemp(options, '.webm')
+    args = _get_encode_args(still, caps, passn=0)
+
+    key = [caps['ffmpegv'], _file_identity(options.infile)]
+    it = iter(args[:-1])
+    for arg in it:
+        if arg in ('-threads', '-v'):
+            next(it)
+        elif arg == '-i':
+            next(it)
+        elif arg != '-nostats':
+            key += [arg]
+    key = hashlib.sha1(json.dumps(key).encode('utf-8')).hexdigest()
+    cachedir = os.path.join(CACHE_DIR, 'covers')
+    cachefile = os.path.join(cachedir, key + '.webm')
+
+    with _get_cover_lock(key):
+        if os.path.exists(cachefile):
+            try:
+                shutil.copyfile(cachefile, still.outfile)
+                os.utime(cachefile, None)
+            except Exception:
+                pass
+            else:
+                if not options.quiet:
+                    print('Reusing encoded cover from {}'.format(cachefile),
+                          file=sys.stderr)
+                return still.outfile
+        _ffmpeg(args, debug=not options.quiet, **_supervise(options))
+        try:
+            if not os.path.isdir(cachedir):
+                os.makedirs(cachedir)
+            _copy_atomic(still.outfile, cachefile)
+            _prune_cache(cachedir, _COVER_CACHE_SIZE)
+        except Exception:
+            # Cache is optional.
+            pass
+    return still.outfile
+
+
+def _encode_cover(options, caps):
+    """
+    Mux once encoded cover with the audio track. Timestamps of the cover
+    frames are stretched so the last one is shown until the end.
+    """
+    stillfile = _encode_still(options, caps)
+    scale = round(options.outduration - 1, 3)
+    args = ['-hide_banner', '-itsscale', scale, '-i', stillfile]
+    if options.ss is not None:
+        args += ['-ss', options.ss]
+    args += ['-i', options.aa]
+    if options.ss is not None and options.ac:
+        # Hack to make copied audio properly work in browsers.
+        args += ['-ss', '0']
+    args += ['-t', round(options.outduration, 3)]
+    args += ['-map', '0:v:0', '-map', _get_audio_stream(options)]
+    args += _get_log_args(options)
+    args += ['-c:v', 'copy']
+    args += _get_audio_args(options)
+    args += ['-sn']
+    args += _get_metadata_args(options)
+    args += ['-y', '-f', 'webm', options.outfile]
+    progress = _get_progress_callback(options, 0)
+    _ffmpeg([_TEXT_TYPE(arg) for arg in args],
+            debug=not options.quiet, progress=progress,
+            **_supervise(options))
+
+
+def _get_gops(options):
+    vstream = _get_video_stream(options)
+    if vstream.startswith('['):
+        raise OptionsError(
+            'cannot find keyframes of {}, use input stream with -chunks'
+            .format(vstream))
+    return probe_gops(options.infile, vstream)
+
+
+def _floor_time(t, precision=6):
+    # FFmpeg uses microseconds internally; rounding to the nearest
+    # value could drop the keyframe we seek to.
+    m = 10 ** precision
+    return math.floor(t * m + 1e-6) / m
+
+
+def _plan_chunks(options, gops):
+    """
+    Split output range at the keyframes closest to the evenly spaced
+    points and distribute video bitrate across chunks proportionally to
+    their complexity.
+    """
+    shift = 0 if options.ss is None else _parse_time(options.ss)
+    end = shift + options.outduration
+    mindur = _CHUNK_MIN_DURATION
+    keys = [t for t, _ in gops if shift + mindur <= t <= end - mindur]
+    bounds = [_floor_time(shift)]
+    for i in _range(1, options.chunks):
+        if not keys:
+            break
+        target = shift + options.outduration * i / options.chunks
+        key = _floor_time(min(keys, key=lambda t: abs(t - target)))
+        if key - bounds[-1] >= mindur:
+            bounds.append(key)
+    bounds.append(end)
+
+    chunks = []
+    for start, stop in zip(bounds, bounds[1:]):
+        size = sum(s for t, s in gops if start <= t < stop)
+        chunks.append({'ss': start, 'duration': stop - start, 'size': size})
+
+    if options.vb:
+        total = options.vb * options.outduration
+        weights = [c['size'] for c in chunks]
+        if not all(weights):
+            weights = [c['duration'] for c in chunks]
+        wsum = sum(weights)
+        for chunk, weight in zip(chunks, weights):
+            vb = total * weight / wsum / chunk['duration']
+            # Don't trust the source encoder too much.
+            chunk['vb'] = min(max(vb, options.vb / 4), options.vb * 4)
+        # Make sure the limit still holds after clamping.
+        scale = total / sum(c['vb'] * c['duration'] for c in chunks)
+        for chunk in chunks:
+            chunk['vb'] = int(chunk['vb'] * scale * 10) / 10
+    return chunks
+
+
+def _get_chunk_options(options, chunk, last=False):
+    sub = copy.copy(options)
+    sub.ss = '{:.6f}'.format(chunk['ss'])
+    sub.to = None
+    if last:
+        sub.t = None if options.t is None and options.to is None else \
+            chunk['duration']
+        sub.outduration = chunk['duration']
+    else:
+        # Exclude the keyframe which starts the next chunk.
+        sub.t = sub.outduration = \
+            math.floor(chunk['duration'] * 1000 - 0.5) / 1000
+    if 'vb' in chunk:
+        sub.vb = chunk['vb']
+    # Audio is encoded once at the concatenation step.
+    sub.an = True
+    sub.ac = False
+    sub.aa = None
+    setattr(sub, 'as', None)
+    sub.af = None
+    sub.outfile = _mktemp(options, '.webm')
+    if not options.singlepass:
+        sub.logfile = _mktemp(options, '-0.log')
+    return sub
+
+
+def _concat_chunks(options, chunks):
+    listfile = _mktemp(options, '.txt')
+    lines = ['ffconcat version 1.0']
+    for chunk in chunks:
+        path = os.path.abspath(chunk.outfile).replace("'", r"'\''")
+        lines.append("file '{}'".format(path))
+    with open(listfile, 'wb') as fh:
+        fh.write('\n'.join(lines).encode('utf-8'))
+
+    args = ['-hide_banner', '-f', 'concat', '-safe', '0', '-i', listfile]
+    args += _get_input_args(options)
+    args += _get_duration_args(options)
+    args += ['-map', '0:v']
+    if not options.an:
+        args += ['-map', _get_audio_stream(options, base=1)]
+    args += _get_log_args(options)
+    args += ['-c:v', 'copy']
+    args += _get_audio_args(options)
+    args += ['-sn']
+    args += _get_metadata_args(options)
+    args += ['-y', '-f', 'webm', options.outfile]
+    _ffmpeg([_TEXT_TYPE(arg) for arg in args], debug=not options.quiet,
+            **_supervise(options))
+
+
+def _pool_map(func, items, workers):
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _encode_chunked(options, caps):
+    gops = _get_gops(options)
+    if options.chunks == 0:
+        options.chunks = max(2, options.threads // 4)
+    chunks = _plan_chunks(options, gops)
+    chunks = [_get_chunk_options(options, chunk, i == len(chunks) - 1)
+              for i, chunk in enumerate(chunks)]
+    for i, chunk in enumerate(chunks):
+        chunk.chunk = i
+    options.jobs = min(len(chunks), options.threads)
+    for chunk in chunks:
+        chunk.threads = max(1, options.threads // options.jobs)
+    options.chunks = len(chunks)
+    options.chunklist = chunks
+    if not options.singlepass:
+        _pool_map(lambda chunk: _first_pass(chunk, caps),
+                  chunks, options.jobs)
+
+
+def _last_pass(options, caps):
+    passn = 0 if options.singlepass else 2
+    if options.deadline_seconds is not None:
+        _deadline_pass(options, caps, passn)
+        return
+    if options.chunks is None:
+        _encode(options, caps, passn=passn)
+        return
+    _pool_map(lambda chunk: _encode(chunk, caps, passn),
+              options.chunklist, options.jobs)
+    _concat_chunks(options, options.chunklist)
+
+
+def _get_speed_costs(options):
+    if options.av1:
+        return _SPEED_COSTS.get(options.av1enc, _SPEED_COSTS['libaom-av1'])
+    return _SPEED_COSTS['libvpx' if options.vp8 else 'libvpx-vp9']
+
+
+def _get_deadline_left(options):
+    return options.deadline_seconds - (time.time() - options.deadline_start)
+
+
+def _pick_deadline_speed(options, rate, budget):
+    """
+    Return the slowest allowed speed which is projected to encode the
+    whole output within budget seconds, or the fastest one if none
+    fits. rate is encode time per second of output at speed 4.
+    """
+    costs = _get_speed_costs(options)
+    speeds = _range(options.deadline_speed, len(costs))
+    for speed in speeds:
+        if options.outduration * rate * costs[speed] <= budget:
+            return speed
+    return min(speeds, key=lambda speed: costs[speed])
+
+
+def _calibrate_deadline(options, caps):
+    """
+    Encode short video-only sample from the middle of the output in a
+    single pass and return encode time per second of output at speed 4.
+    """
+    costs = _get_speed_costs(options)
+    shift = 0 if options.ss is None else _parse_time(options.ss)
+    duration = min(_SAMPLE_DURATION, options.outduration / 4)
+    sample = _get_sample_options(
+        options, shift + (options.outduration - duration) / 2, duration,
+        singlepass=True)
+    sample.speed = max(4, options.deadline_speed)
+    sample.an = True
+    sample.audiofile = None
+    start = time.time()
+    _encode(sample, caps, passn=0)
+    return (time.time() - start) / duration / costs[sample.speed]
+
+
+def _get_deadline_hook(options, attempt):
+    """
+    Cancel the running last pass once it's projected to miss the
+    deadline and restarting it with faster speed would finish earlier.
+    """
+    costs = _get_speed_costs(options)
+    cost = costs[attempt.speed]
+
+    def hook(event):
+        out_time = event['out_time']
+        if (event['done'] or not out_time or attempt.deadline_behind or
+                event['elapsed'] < _DEADLINE_GRACE):
+            return
+        rate = event['elapsed'] / out_time / cost
+        projected = rate * cost * (options.outduration - out_time)
+        left = _get_deadline_left(options)
+        if projected <= left + options.deadline_seconds * _DEADLINE_SLACK:
+            return
+        speed = _pick_deadline_speed(options, rate, left)
+        if (speed <= attempt.speed or
+                options.outduration * rate * costs[speed] >= projected):
+            return
+        options.deadline_rate = rate
+        attempt.deadline_behind = True
+        # Killing waits for the output to be read, don't block the reader.
+        thread = threading.Thread(target=attempt.cancel.cancel)
+        thread.daemon = True
+        thread.start()
+    return hook
+
+
+def _deadline_pass(options, caps, passn):
+    """
+    Run the last pass with the slowest speed which is projected to
+    finish before -deadline-seconds, restart it with faster one if it
+    falls behind. Killed attempts are lost, first pass statistics don't
+    depend on speed so they are reused.
+    """
+    while True:
+        left = _get_deadline_left(options)
+        attempt = copy.copy(options)
+        attempt.speed = _pick_deadline_speed(
+            options, options.deadline_rate, left)
+        attempt.deadline_behind = False
+        attempt.cancel = CancelToken()
+        attempt.progress_hook = _get_deadline_hook(options, attempt)
+        options.deadline_speeds.append(attempt.speed)
+        if not options.quiet:
+            print('Deadline: {:.1f}s left, running last pass with speed {}'
+                  .format(left, attempt.speed),
+                  file=sys.stderr)
+        parent = getattr(options, 'cancel', None)
+        if parent is not None and \
+                not parent._register(attempt.cancel.cancel):
+            raise CancelledError('encode was cancelled')
+        start = time.time()
+        try:
+            _encode(attempt, caps, passn)
+        except CancelledError:
+            if not attempt.deadline_behind or \
+                    (parent is not None and parent.cancelled):
+                raise
+            options.deadline_restarts += 1
+            continue
+        finally:
+            if parent is not None:
+                parent._unregister(attempt.cancel.cancel)
+        options.speed = attempt.speed
+        options.deadline_rate = (time.time() - start) / \
+            options.outduration / _get_speed_costs(options)[options.speed]
+        return
+
+
+def _fit_limit(options, caps):
+    """
+    Re-run the last pass with corrected video bitrate until output
+    fits the limit. First pass statistics don't depend on bitrate so
+    they are reused.
+    """
+    limit = int(options.l * 1024 * 1024)
+    lower = limit * (1 - options.lt / 100)
+    # Quality limited encodes are allowed to be smaller.
+    if options.crf is not None:
+        lower = 0
+    best = None
+    prevsize = None
+    try:
+        for attempt in _range(options.la):
+            size = os.path.getsize(options.outfile)
+            if lower <= size <= limit:
+                break
+            if prevsize is not None and abs(size - prevsize) < limit / 100:
+                # Encoder hit quality bounds, bitrate doesn't matter.
+                break
+            prevsize = size
+            if size < limit:
+                if best is None:
+                    best = _mktemp(options, '.webm')
+                shutil.copyfile(options.outfile, best)
+            # Audio size doesn't depend on the video bitrate.
+            abits = options.ab * options.outduration
+            vbits = size * 8 / 1024 - abits
+            target = (limit + lower) / 2 * 8 / 1024 - abits
+            if vbits <= 0 or target <= 0:
+                break
+            factor = target / vbits
+            vb = int(options.vb * factor * 10) / 10
+            if vb < 0.1:
+                break
+            if (options.deadline_seconds is not None and
+                    options.outduration * options.deadline_rate *
+                    min(_get_speed_costs(options)[options.deadline_speed:]) >
+                    _get_deadline_left(options)):
+                if not options.quiet:
+                    print('Output size is {} B, no time left before the '
+                          'deadline to re-run last pass'.format(size),
+                          file=sys.stderr)
+                break
+            if not options.quiet:
+                print('Output size is {} B, re-running last pass with {}k '
+                      'video bitrate ({}/{})'.format(
+                          size, vb, attempt + 1, options.la),
+                      file=sys.stderr)
+            options.vb = vb
+            for chunk in getattr(options, 'chunklist', []):
+                chunk.vb = int(chunk.vb * factor * 10) / 10
+            _last_pass(options, caps)
+    finally:
+        if best is not None and os.path.getsize(options.outfile) > limit:
+            shutil.copyfile(best, options.outfile)
+
+
+def _get_sample_options(options, start, duration, singlepass=None):
+    sub = copy.copy(options)
+    sub.ss = '{:.6f}'.format(_floor_time(start))
+    sub.t = sub.outduration = duration
+    sub.to = None
+    sub.chunks = None
+    sub.la = 0
+    sub.progress = None
+    sub.quiet = True
+    # Offsets are in the source, not in the trimmed intermediate.
+    sub.prefiltered = None
+    sub.outfile = _mktemp(options, '.webm')
+    if singlepass is not None:
+        sub.singlepass = singlepass
+    if not sub.singlepass:
+        sub.logfile = _mktemp(options, '-0.log')
+    return sub
+
+
+def _get_samples(options):
+    shift = 0 if options.ss is None else _parse_time(options.ss)
+    count = _SAMPLE_COUNT
+    duration = _SAMPLE_DURATION
+    if options.outduration < count * duration:
+        count = 1
+        duration = options.outduration
+    samples = []
+    for i in _range(count):
+        start = shift + (options.outduration - duration) * (i + 0.5) / count
+        samples.append(_get_sample_options(options, start, duration))
+    return samples
+
+
+def _encode_samples(options, caps, samples, singlepass=None):
+    """
+    Encode samples in parallel and extrapolate results to the whole
+    output duration.
+    """
+    if singlepass is None:
+        singlepass = options.singlepass
+    workers = min(len(samples), options.threads)
+    # Only the own processes, concurrent encodes share rusage children.
+    usages = []
+    for sample in samples:
+        sample.threads = max(1, options.threads // workers)
+        sample.usages = usages
+
+    def run(sample):
+        if singlepass:
+            _encode(sample, caps, passn=0)
+        else:
+            _encode(sample, caps, passn=1)
+            _encode(sample, caps, passn=2)
+
+    # Samples run concurrently, so only the whole batch is meaningful.
+    start = time.time()
+    _pool_map(run, samples, workers)
+    walltime = time.time() - start
+    cputime = None
+    if usages and None not in usages:
+        cputime = sum(usage['user'] + usage['sys'] for usage in usages)
+    duration = sum(sample.outduration for sample in samples)
+    size = sum(os.path.getsize(sample.outfile) for sample in samples)
+    scale = options.outduration / duration
+    return {
+        'samples': len(samples),
+        'sample_duration': samples[0].outduration,
+        'predicted_size': int(size * scale),
+        # Samples use less threads than the full encode so that's the
+        # upper bound.
+        'wall_seconds': walltime * scale,
+        'cpu_seconds': None if cputime is None else cputime * scale,
+    }
+
+
+def estimate(options, caps):
+    """
+    Predict output size and required CPU time by encoding a few evenly
+    spaced samples of the output range with the same settings.
+    """
+    result = _encode_samples(options, caps, _get_samples(options))
+    limit = None if options.l is None else int(options.l * 1024 * 1024)
+    result.update({
+        'infile': _get_main_infile(options),
+        'outfile': options.outfile,
+        'outduration': options.outduration,
+        'video_bitrate': options.vb,
+        'audio_bitrate': options.ab,
+        'crf': options.crf,
+        'limit': limit,
+        'fits': None if limit is None else result['predicted_size'] <= limit,
+    })
+    return result
+
+
+def _pick_crf(options, caps):
+    """
+    Find the best quality level which fits the limit with binary search
+    over sample encodes. Bitrate is kept as the upper bound.
+    """
+    limit = int(options.l * 1024 * 1024)
+    samples = _get_samples(options)
+    # Lossless mode is out of question.
+    lo = max(4, 0 if options.qmin is None else options.qmin)
+    hi = 63 if options.qmax is None else options.qmax
+    best = hi
+    while lo <= hi:
+        crf = (lo + hi) // 2
+        for sample in samples:
+            sample.crf = crf
+            # VP8 can't do pure quality mode.
+            sample.vb = options.vb if options.vp8 else 0
+        size = _encode_samples(
+            options, caps, samples, singlepass=True)['predicted_size']
+        if not options.quiet:
+            print('CRF {}: predicted size {} B'.format(crf, size),
+                  file=sys.stderr)
+        if size <= limit:
+            best = crf
+            hi = crf - 1
+        else:
+            lo = crf + 1
+    return best
+
+
+# Phases which process the whole output duration.
+_MEDIA_PHASES = [
+    'remux', 'smartcut', 'cover', 'prefilter', 'pass 1', 'pass 2', 'encode',
+]
+
+
+class _PhaseStats(object):
+    """
+    Wall time of the encode phases together with CPU time and peak RSS
+    of the child processes. Shared by all sub-encodes, processes are
+    accounted to the phase which is current when they exit.
+    """
+
+    def __init__(self):
+        self.phases = []
+        self._lock = threading.Lock()
+
+    def start(self, name):
+        with self._lock:
+            now = time.time()
+            self._finish(now)
+            self.phases.append({
+                'name': name,
+                'start': now,
+                'wall': None,
+                'processes': 0,
+                'user': None,
+                'sys': None,
+                'maxrss': None,
+            })
+
+    def finish(self):
+        with self._lock:
+            self._finish(time.time())
+
+    def _finish(self, now):
+        if self.phases and self.phases[-1]['wall'] is None:
+            self.phases[-1]['wall'] = now - self.phases[-1]['start']
+
+    def add_process(self, usage):
+        with self._lock:
+            if not self.phases:
+                return
+            phase = self.phases[-1]
+            phase['processes'] += 1
+            if usage is None:
+                return
+            phase['user'] = (phase['user'] or 0) + usage['user']
+            phase['sys'] = (phase['sys'] or 0) + usage['sys']
+            phase['maxrss'] = max(phase['maxrss'] or 0, usage['maxrss'])
+
+
+def _start_phase(options, name):
+    stats = getattr(options, 'stats', None)
+    if stats is not None:
+        stats.start(name)
+
+
+def get_phase_report(options):
+    """
+    Return list of finished phases with encode fps and realtime factor
+    added to the ones which process the whole output.
+    """
+    stats = getattr(options, 'stats', None)
+    if stats is None:
+        return []
+    phases = []
+    for phase in stats.phases:
+        phase = dict(phase)
+        if phase['wall'] is None:
+            continue
+        phase['fps'] = phase['realtime'] = None
+        outduration = getattr(options, 'outduration', None)
+        if phase['name'] in _MEDIA_PHASES and outduration and phase['wall']:
+            phase['realtime'] = outduration / phase['wall']
+            if getattr(options, 'infps', None):
+                phase['fps'] = phase['realtime'] * options.infps
+        phases.append(phase)
+    return phases
+
+
+def _write_stats_json(options, status, error=None):
+    phases = get_phase_report(options)
+    cpu = [p['user'] + p['sys'] for p in phases if p['user'] is not None]
+    maxrss = [p['maxrss'] for p in phases if p['maxrss'] is not None]
+    outfile = getattr(options, 'outfile', None)
+    data = {
+        'version': __version__,
+        'infile': _get_main_infile(options),
+        'outfile': outfile,
+        'status': status,
+        'error': error,
+        'outduration': getattr(options, 'outduration', None),
+        'speed': getattr(options, 'speed', None),
+        'deadline_speeds': getattr(options, 'deadline_speeds', None),
+        'deadline_restarts': getattr(options, 'deadline_restarts', None),
+        'size': os.path.getsize(outfile)
+        if status == 'ok' and outfile and os.path.exists(outfile) else None,
+        'wall': sum(phase['wall'] for phase in phases),
+        'cpu': sum(cpu) if cpu else None,
+        'maxrss': max(maxrss) if maxrss else None,
+        'phases': phases,
+    }
+    _write_json(os.path.abspath(options.stats_json), data)
 
 
 def encode(options, caps):
-    import multiprocessing
+    options.deadline_start = time.time()
+    _start_phase(options, 'probe')
     options.__dict__.update(_get_input_info(options))
     if options.outfile is None:
         options.outfile = _get_output_filename(options)
     if options.vb is None:
         options.vb = _calc_video_bitrate(options)
-    options.threads = multiprocessing.cpu_count()
-    if not options.singlepass:
+    if getattr(options, 'threads', None) is None:
+        options.threads, source = get_cpu_budget()
+        if _is_verbose(options):
+            print('CPU budget: {} threads ({})'.format(
+                      options.threads, source),
+                  file=sys.stderr)
+    key = None
+    if options.output_cache is not None and not options.estimate:
+        key = _reuse_output(options, caps)
+        if getattr(options, 'cached', False):
+            return
+    if options.autocrf:
+        _start_phase(options, 'autocrf')
+        options.crf = _pick_crf(options, caps)
+    if options.estimate:
+        _start_phase(options, 'estimate')
+        options.estimation = estimate(options, caps)
+        return
+    _encode_output(options, caps)
+    if key is not None:
+        _store_output(options, key)
+
+
+def _encode_output(options, caps):
+    if _remux(options):
+        return
+    if options.smartcut and _smartcut(options, caps):
+        return
+    if options.cover is not None and _is_still_cover(options):
+        _start_phase(options, 'cover')
+        _encode_cover(options, caps)
+        return
+    if options.chunks is not None:
+        _start_phase(options, 'chunks' if options.singlepass else 'pass 1')
+        _encode_chunked(options, caps)
+    elif not options.singlepass:
+        if options.prefilter:
+            _start_phase(options, 'prefilter')
+            _prefilter(options, caps)
+        _start_phase(options, 'pass 1')
         # NOTE: Py3 always returns unicode for the second parameter, Py2
         # returns bytes with bytes suffix/without suffix and unicode with
         # unicode suffix. Since we use unicode_literals and provide suffix,
         # it should always be unicode.
         logfh, options.logfile = tempfile.mkstemp(suffix='-0.log')
         os.close(logfh)
-        _encode(options, caps, passn=1)
-    passn = 0 if options.singlepass else 2
-    _encode(options, caps, passn=passn)
+        _first_pass_with_audio(options, caps)
+    if options.deadline_seconds is not None:
+        _start_phase(options, 'calibrate')
+        options.deadline_rate = _calibrate_deadline(options, caps)
+        options.deadline_speeds = []
+        options.deadline_restarts = 0
+    _start_phase(options, 'encode' if options.singlepass else 'pass 2')
+    _last_pass(options, caps)
+    if (options.l is not None and
+            options.crf is None and
+            not options.singlepass and
+            not options.no_size_stats):
+        _record_size(options)
+    if options.la:
+        _start_phase(options, 'limit fit')
+        _fit_limit(options, caps)
 
 
 def print_stats(options, start):
@@ -1152,10 +3942,22 @@ def print_stats(options, start):
     filepath = os.path.abspath(options.outfile)
     filepath = filepath.replace('\\', r'\\').replace("'", r"'\''")
     print("Output filepath: '{}'".format(filepath), file=sys.stderr)
+    if getattr(options, 'cached', False):
+        print('Output was taken from the cache', file=sys.stderr)
+    if getattr(options, 'remuxed', False):
+        print('Input was remuxed without re-encoding', file=sys.stderr)
+    if hasattr(options, 'smartcut_head'):
+        print('Smart cut: re-encoded only first {:.3f}s'.format(
+                  options.smartcut_head),
+              file=sys.stderr)
     print('Output duration: {}'.format(_timestamp(options.outduration)),
           file=sys.stderr)
     print('Output video bitrate: {}k'.format(options.vb), file=sys.stderr)
     print('Output audio bitrate: {}k'.format(options.ab), file=sys.stderr)
+    if getattr(options, 'deadline_speeds', None):
+        print('Deadline: last pass speed {} ({} restarts)'.format(
+                  options.speed, options.deadline_restarts),
+              file=sys.stderr)
     size = os.path.getsize(options.outfile)
     sizeinfo = 'Output file size: {} B'.format(size)
     if size >= 1024:
@@ -1169,13 +3971,23 @@ def print_stats(options, start):
         elif size < limit:
             sizeinfo += ', underweight: {} B'.format(limit - size)
     print(sizeinfo, file=sys.stderr)
+    for phase in get_phase_report(options):
+        info = '{:.2f}s'.format(phase['wall'])
+        if phase['user'] is not None:
+            info += ', CPU {:.2f}s user {:.2f}s sys'.format(
+                phase['user'], phase['sys'])
+            info += ', peak RSS {:.1f} MiB'.format(phase['maxrss'] / 1024)
+        if phase['fps'] is not None:
+            info += ', {:.1f} fps'.format(phase['fps'])
+        if phase['realtime'] is not None:
+            info += ', {:.2f}x realtime'.format(phase['realtime'])
+        print('Phase {}: {}'.format(phase['name'], info), file=sys.stderr)
     runtime = _timestamp(time.time() - start)
     print('Overall time spent: {}'.format(runtime), file=sys.stderr)
 
 
 def _is_verbose(options):
-    default = '-v' in ARGS
-    return getattr(options, 'verbose', default)
+    return getattr(options, 'verbose', False)
 
 
 def cleanup(options):
@@ -1184,34 +3996,853 @@ def cleanup(options):
             os.remove(options.logfile)
         if hasattr(options, 'luafile'):
             os.remove(options.luafile)
+        for path in getattr(options, 'tmpfiles', []):
+            if os.path.exists(path):
+                os.remove(path)
     except Exception as exc:
         if _is_verbose(options):
             exc = '\n\n' + traceback.format_exc()[:-1]
         print('Error during cleanup: {}'.format(exc), file=sys.stderr)
 
 
+def _read_manifest(path):
+    with open(path, 'rb') as fh:
+        data = fh.read().decode('utf-8-sig')
+    if os.path.splitext(path)[1].lower() == '.csv':
+        import csv
+        lines = data.splitlines()
+        if _PY2:
+            lines = [line.encode('utf-8') for line in lines]
+        entries = []
+        for row in csv.DictReader(lines):
+            entry = {}
+            for k, v in row.items():
+                if _PY2:
+                    k, v = k.decode('utf-8'), (v or b'').decode('utf-8')
+                entry[k.strip()] = v.strip()
+            entries.append(entry)
+        return entries
+    entries = json.loads(data)
+    if (not isinstance(entries, list) or
+            not all(isinstance(entry, dict) for entry in entries)):
+        raise OptionsError('manifest must be a list of objects')
+    return entries
+
+
+def _entry_to_args(parser, entry, refuse=()):
+    """
+    Convert manifest entry (option names without dashes) to the
+    command-line arguments. Options with destinations from refuse list
+    are not allowed.
+    """
+    import argparse
+    actions = {}
+    for action in parser._actions:
+        # Destination names, e.g. "singlepass" for "-1", are accepted
+        # too but real option names take precedence.
+        opt = action.option_strings[0] if action.option_strings else None
+        actions[action.dest] = opt, action
+    for action in parser._actions:
+        for opt in action.option_strings:
+            actions[opt.lstrip('-')] = opt, action
+    args = []
+    for key, value in entry.items():
+        try:
+            opt, action = actions[key]
+        except KeyError:
+            raise OptionsError('unknown option "{}"'.format(key))
+        if action.default == argparse.SUPPRESS:
+            # Help and version print to stdout and exit.
+            raise OptionsError('option "{}" is not allowed in jobs'
+                               .format(key))
+        if action.dest in refuse:
+            raise OptionsError('option "{}" is not allowed in server jobs '
+                               'without --serve-unsafe'.format(key))
+        # Values read from CSV are always strings.
+        if action.nargs == 0 and isinstance(value, _TEXT_TYPE):
+            value = value.lower() in ('1', 'true', 'yes', 'y')
+        if value is None or value is False or value == '':
+            continue
+        if opt is None:
+            args += [_TEXT_TYPE(value)]
+        elif value is True:
+            args += [opt]
+        else:
+            args += ['{}={}'.format(opt, value)]
+    return args
+
+
+def _split_batch_args(args):
+    """
+    Separate batch-only options and input files from the options
+    common for all jobs.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog=__stitle__, add_help=False)
+    parser.add_argument('--batch')
+    parser.add_argument('--jobs', type=int)
+    parser.add_argument('--batch-report')
+    batchopts, args = parser.parse_known_args(args)
+    if batchopts.jobs is not None and batchopts.jobs < 1:
+        parser.error('number of jobs must be positive')
+    common = []
+    infiles = []
+    it = iter(args)
+    for arg in it:
+        if arg == '-i':
+            infiles.append(next(it, ''))
+        else:
+            common.append(arg)
+    return batchopts, common, infiles
+
+
+def _check_encoders(options, caps):
+    """
+    Check that FFmpeg supports the encoders required by the options.
+    Used when several jobs are run with the single capabilities probe.
+    """
+    if not caps['encoders']:
+        # Checkings are disabled.
+        return
+    required = []
+    if options.av1:
+        required += [options.av1enc]
+    elif options.vp8:
+        required += ['libvpx']
+    if options.vorbis and not options.an and not options.ac:
+        required += ['libvorbis']
+    for encoder in required:
+        if encoder not in caps['encoders']:
+            raise DependencyError(
+                'FFmpeg is not compiled with {} support'.format(encoder))
+
+
+# Name, type, help and histogram buckets of the exported metrics.
+_METRIC_DEFS = [
+    ('webm_jobs', 'counter', 'Finished encode jobs.', None),
+    ('webm_jobs_running', 'gauge', 'Encode jobs in progress.', None),
+    ('webm_queue_depth', 'gauge', 'Encode jobs waiting to start.', None),
+    ('webm_job_duration_seconds', 'histogram', 'Wall time of the jobs.',
+     [1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600]),
+    ('webm_phase_duration_seconds', 'histogram',
+     'Wall time of the encode phases.',
+     [0.1, 0.5, 1, 5, 15, 60, 300, 1800]),
+    ('webm_phase_cpu_seconds', 'counter',
+     'CPU time of FFmpeg processes by encode phase.', None),
+    ('webm_encode_fps', 'histogram', 'Speed of the final encode pass.',
+     [1, 2, 5, 10, 25, 50, 100, 250]),
+    ('webm_input_bytes', 'counter', 'Size of the encoded inputs.', None),
+    ('webm_output_bytes', 'counter', 'Size of the produced outputs.', None),
+    ('webm_output_seconds', 'counter',
+     'Duration of the produced outputs.', None),
+    ('webm_cpu_seconds', 'counter', 'CPU time of FFmpeg processes.', None),
+    ('webm_ffmpeg_failures', 'counter',
+     'Jobs failed because of FFmpeg error or timeout.', None),
+    ('webm_limit_results', 'counter',
+     'Outcomes of the jobs with size limit.', None),
+]
+_METRICS = {}
+_METRICS_LOCK = threading.Lock()
+
+
+def _metric_sample(name, labels):
+    """Return mutable sample of the metric, caller must hold the lock."""
+    samples = _METRICS.setdefault(name, {})
+    key = tuple(sorted((labels or {}).items()))
+    if key not in samples:
+        buckets = [d[3] for d in _METRIC_DEFS if d[0] == name][0]
+        # Histogram is per-bucket counts, count and sum.
+        samples[key] = [0] * len(buckets) + [0, 0] if buckets else [0]
+    return samples[key]
+
+
+def _metric_add(name, value=1, labels=None):
+    with _METRICS_LOCK:
+        _metric_sample(name, labels)[0] += value
+
+
+def _metric_set(name, value, labels=None):
+    with _METRICS_LOCK:
+        _metric_sample(name, labels)[0] = value
+
+
+def _metric_observe(name, value, labels=None):
+    buckets = [d[3] for d in _METRIC_DEFS if d[0] == name][0]
+    with _METRICS_LOCK:
+        sample = _metric_sample(name, labels)
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                sample[i] += 1
+        sample[-2] += 1
+        sample[-1] += value
+
+
+def _format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k, _TEXT_TYPE(v).replace('\\', r'\\').replace('"', r'\"'))
+        for k, v in labels) + '}'
+
+
+def _format_metrics():
+    """Render all metrics in OpenMetrics text format."""
+    lines = []
+    with _METRICS_LOCK:
+        for name, mtype, mhelp, buckets in _METRIC_DEFS:
+            lines.append('# TYPE {} {}'.format(name, mtype))
+            lines.append('# HELP {} {}'.format(name, mhelp))
+            for labels, sample in sorted(_METRICS.get(name, {}).items()):
+                if mtype == 'counter':
+                    lines.append('{}_total{} {}'.format(
+                        name, _format_labels(labels), sample[0]))
+                elif mtype == 'gauge':
+                    lines.append('{}{} {}'.format(
+                        name, _format_labels(labels), sample[0]))
+                else:
+                    for bound, count in zip(buckets + ['+Inf'],
+                                            sample[:-2] + [sample[-2]]):
+                        lines.append('{}_bucket{} {}'.format(
+                            name,
+                            _format_labels(labels, [(
+                                'le', bound if bound == '+Inf'
+                                else repr(float(bound)))]),
+                            count))
+                    lines.append('{}_count{} {}'.format(
+                        name, _format_labels(labels), sample[-2]))
+                    lines.append('{}_sum{} {}'.format(
+                        name, _format_labels(labels), sample[-1]))
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def _record_metrics(options, status, elapsed, exc=None):
+    """
+    Account finished job and rewrite metrics textfile if requested.
+    """
+    _metric_add('webm_jobs', labels={'status': status})
+    _metric_observe('webm_job_duration_seconds', elapsed)
+    for phase in get_phase_report(options):
+        labels = {'phase': phase['name']}
+        _metric_observe('webm_phase_duration_seconds', phase['wall'], labels)
+        if phase['user'] is not None:
+            cpu = phase['user'] + phase['sys']
+            _metric_add('webm_phase_cpu_seconds', cpu, labels)
+            _metric_add('webm_cpu_seconds', cpu)
+        if phase['name'] in ('pass 2', 'encode') and phase['fps']:
+            _metric_observe('webm_encode_fps', phase['fps'])
+    if isinstance(exc, FFmpegError):
+        reason = 'timeout' if isinstance(exc, FFmpegTimeoutError) \
+            else 'error'
+        _metric_add('webm_ffmpeg_failures', labels={'reason': reason})
+    infile = _get_main_infile(options)
+    if os.path.isfile(infile):
+        _metric_add('webm_input_bytes', os.path.getsize(infile))
+    if status == 'ok' and not options.estimate:
+        size = os.path.getsize(options.outfile)
+        _metric_add('webm_output_bytes', size)
+        _metric_add('webm_output_seconds', options.outduration)
+        if options.l is not None:
+            limit = int(options.l * 1024 * 1024)
+            result = 'overweight' if size > limit \
+                else 'underweight' if size < limit * (1 - options.lt / 100) \
+                else 'fit'
+            _metric_add('webm_limit_results', labels={'result': result})
+    if options.metrics_textfile is not None:
+        _write_metrics_textfile(options.metrics_textfile)
+
+
+def _write_metrics_textfile(path):
+    try:
+        path = os.path.abspath(path)
+        _write_atomic(path, _format_metrics().encode('utf-8'))
+        # Temporary file is private, let the exporter read it.
+        os.chmod(path, 0o644)
+    except Exception as exc:
+        # Metrics must not fail the encodes.
+        print('Cannot write metrics: {}'.format(exc), file=sys.stderr)
+
+
+def _start_metrics(args):
+    """
+    Start metrics server if requested. It serves all jobs of the
+    process, so it's started once before they are run.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog=__stitle__, add_help=False)
+    parser.add_argument(
+        '--metrics-port', const=_METRICS_ADDRESS, nargs='?')
+    metricsopts, _ = parser.parse_known_args(args)
+    if metricsopts.metrics_port is None:
+        return None
+    server = _start_metrics_server(metricsopts.metrics_port)
+    print('Serving metrics on {}'.format(metricsopts.metrics_port),
+          file=sys.stderr)
+    return server
+
+
+def _start_metrics_server(address):
+    """
+    Serve metrics on ``GET /metrics`` from the background thread.
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, fmt, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.rstrip('/') != '/metrics':
+                self.send_error(404)
+                return
+            _reply_metrics(self)
+
+    address = _parse_address(address)
+    if not isinstance(address, tuple):
+        raise OptionsError('metrics address must be [host:]port')
+    server = HTTPServer(address, Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _reply_metrics(handler):
+    body = _format_metrics().encode('utf-8')
+    handler.send_response(200)
+    handler.send_header(
+        'Content-Type',
+        'application/openmetrics-text; version=1.0.0; charset=utf-8')
+    handler.send_header('Content-Length', _TEXT_TYPE(len(body)))
+    handler.end_headers()
+    handler.wfile.write(body)
+
+
+def _run_job(caps, options):
+    result = {
+        'infile': _get_main_infile(options),
+        'outfile': options.outfile,
+        'status': 'failed',
+        'error': None,
+        'time': None,
+        'size': None,
+    }
+    start = time.time()
+    options.stats = _PhaseStats()
+    error = None
+    _metric_add('webm_jobs_running')
+    try:
+        _check_encoders(options, caps)
+        encode(options, caps)
+        result['outfile'] = options.outfile
+        if options.estimate:
+            result['estimate'] = options.estimation
+            result['size'] = options.estimation['predicted_size']
+        else:
+            result['size'] = os.path.getsize(options.outfile)
+            result['remuxed'] = getattr(options, 'remuxed', False)
+            result['cached'] = getattr(options, 'cached', False)
+        result['status'] = 'ok'
+    except Exception as exc:
+        error = exc
+        if _is_verbose(options):
+            exc = '\n\n' + traceback.format_exc()[:-1]
+        result['error'] = _TEXT_TYPE(exc)
+    finally:
+        options.stats.start('cleanup')
+        cleanup(options)
+        options.stats.finish()
+        _metric_add('webm_jobs_running', -1)
+    result['time'] = time.time() - start
+    result['phases'] = get_phase_report(options)
+    if options.stats_json is not None:
+        _write_stats_json(options, result['status'], result['error'])
+    status = 'cancelled' if isinstance(error, CancelledError) \
+        else result['status']
+    _record_metrics(options, status, result['time'], error)
+    return result
+
+
+def run_batch(caps):
+    """
+    Run several encodes with bounded concurrency. Options are validated
+    for all jobs before the first encode is started.
+    """
+    from multiprocessing.pool import ThreadPool
+    parser = _get_parser(caps)
+    batchopts, common, infiles = _split_batch_args(ARGS)
+    jobargs = [common + ['-i', infile] for infile in infiles]
+    if batchopts.batch is not None:
+        for entry in _read_manifest(batchopts.batch):
+            jobargs.append(common + _entry_to_args(parser, entry))
+    if not jobargs:
+        raise OptionsError('no batch jobs were specified')
+
+    jobs = [process_options(caps, args) for args in jobargs]
+    outfiles = [job.outfile for job in jobs if job.outfile is not None]
+    if len(set(outfiles)) != len(outfiles):
+        raise OptionsError('output files of batch jobs must be different')
+    statsfiles = [job.stats_json for job in jobs
+                  if job.stats_json is not None]
+    if len(set(statsfiles)) != len(statsfiles):
+        raise OptionsError('stats files of batch jobs must be different')
+    if any(job.p for job in jobs):
+        raise OptionsError('interactive mode cannot be used in batch mode')
+
+    cpus = get_cpu_budget()[0]
+    workers = batchopts.jobs or max(1, cpus // 4)
+    workers = max(1, min(workers, len(jobs)))
+    for job in jobs:
+        if job.threads is None:
+            job.threads = max(1, cpus // workers)
+        job.quiet = True
+
+    print('Running {} jobs, {} at a time'.format(len(jobs), workers),
+          file=sys.stderr)
+    _metric_set('webm_queue_depth', len(jobs))
+    start = time.time()
+    counter = {'done': 0}
+    lock = threading.Lock()
+
+    def run(job):
+        _metric_add('webm_queue_depth', -1)
+        result = _run_job(caps, job)
+        info = result['outfile'] if result['status'] == 'ok' \
+            else result['error']
+        with lock:
+            counter['done'] += 1
+            print('[{}/{}] {}: {}'.format(
+                      counter['done'], len(jobs), result['infile'], info),
+                  file=sys.stderr)
+        return result
+
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(run, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    print_batch_stats(results, start)
+    if batchopts.batch_report is not None:
+        _write_json(os.path.abspath(batchopts.batch_report), results)
+    failed = [result for result in results if result['status'] != 'ok']
+    if failed:
+        raise BatchError(
+            '{} of {} jobs failed'.format(len(failed), len(jobs)), failed)
+
+
+def print_batch_stats(results, start):
+    print('='*50, file=sys.stderr)
+    for result in results:
+        if result['status'] == 'ok':
+            info = '{}, {:.2f} MiB'.format(
+                result['outfile'], result['size']/1024/1024)
+        else:
+            info = result['error']
+        print('[{}] {} ({}): {}'.format(
+                  result['status'].upper(), result['infile'],
+                  _timestamp(result['time']), info),
+              file=sys.stderr)
+    ok = sum(1 for result in results if result['status'] == 'ok')
+    print('Jobs succeeded: {}/{}'.format(ok, len(results)), file=sys.stderr)
+    runtime = _timestamp(time.time() - start)
+    print('Overall time spent: {}'.format(runtime), file=sys.stderr)
+
+
+def _parse_address(address):
+    if address.startswith('unix:'):
+        return address[5:]
+    host, _, port = address.rpartition(':')
+    try:
+        return host or '127.0.0.1', int(port)
+    except ValueError:
+        raise OptionsError('bad server address {}'.format(address))
+
+
+def serve(caps):
+    """
+    Run HTTP server accepting encode jobs. Capabilities and probe
+    records stay warm in memory between the jobs.
+    """
+    import argparse
+    try:
+        import queue
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+    except ImportError:
+        import Queue as queue
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import ThreadingMixIn
+
+    sparser = argparse.ArgumentParser(prog=__stitle__, add_help=False)
+    sparser.add_argument('--serve')
+    sparser.add_argument('--jobs', type=int)
+    sparser.add_argument('--serve-unsafe', action='store_true')
+    serveopts, common = sparser.parse_known_args(ARGS)
+    refuse = () if serveopts.serve_unsafe else _SERVE_UNSAFE
+    address = _parse_address(serveopts.serve)
+    cpus = get_cpu_budget()[0]
+    workers = max(1, serveopts.jobs or cpus // 4)
+    parser = _get_parser(caps, exit_on_error=False)
+
+    jobs = {}
+    order = []
+    tokens = {}
+    pending = queue.Queue()
+    lock = threading.Lock()
+    counter = {'id': 0}
+
+    def submit(entry):
+        if not isinstance(entry, dict):
+            raise OptionsError('job must be an object')
+        args = common + _entry_to_args(parser, entry, refuse)
+        options = process_options(caps, args, exit_on_error=False)
+        if options.p:
+            raise OptionsError(
+                'interactive mode cannot be used in server mode')
+        _check_encoders(options, caps)
+        if options.threads is None:
+            options.threads = max(1, cpus // workers)
+        options.quiet = True
+        options.cancel = CancelToken()
+        with lock:
+            counter['id'] += 1
+            job = {
+                'id': _TEXT_TYPE(counter['id']),
+                'status': 'queued',
+                'options': entry,
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'result': None,
+            }
+            jobs[job['id']] = job
+            order.append(job['id'])
+            # Forget the oldest finished jobs.
+            finished = [jid for jid in order
+                        if jobs[jid]['finished'] is not None]
+            for jid in finished[:max(0, len(finished) - _SERVE_HISTORY)]:
+                order.remove(jid)
+                del jobs[jid]
+        tokens[job['id']] = options.cancel
+        pending.put((job, options))
+        _metric_set('webm_queue_depth', pending.qsize())
+        return job
+
+    def dump(data):
+        return json.dumps(data, sort_keys=True).encode('utf-8')
+
+    def cancel(jid):
+        with lock:
+            job = jobs.get(jid)
+            if job is None or job['finished'] is not None:
+                return job
+            if job['status'] == 'queued':
+                job['status'] = 'cancelled'
+                job['finished'] = time.time()
+                return job
+            token = tokens[jid]
+        # Worker marks the job once its FFmpeg processes are killed.
+        token.cancel()
+        return job
+
+    def worker():
+        while True:
+            job, options = pending.get()
+            _metric_set('webm_queue_depth', pending.qsize())
+            with lock:
+                if job['status'] == 'cancelled':
+                    del tokens[job['id']]
+                    continue
+                job['status'] = 'running'
+                job['started'] = time.time()
+            result = _run_job(caps, options)
+            with lock:
+                job['result'] = result
+                job['status'] = 'cancelled' if options.cancel.cancelled \
+                    else result['status']
+                job['finished'] = time.time()
+                del tokens[job['id']]
+
+    class Handler(BaseHTTPRequestHandler):
+        server_version = '{}/{}'.format(__title__, __version__)
+
+        def address_string(self):
+            # Unix socket has no client address.
+            return self.client_address[0] if self.client_address else ''
+
+        def log_message(self, fmt, *args):
+            print('{} {}'.format(
+                      self.address_string(), fmt % args),
+                  file=sys.stderr)
+
+        def reply(self, code, data):
+            self.send(code, dump(data))
+
+        def send(self, code, body):
+            # Never called with the lock held, slow client would block
+            # workers and other requests.
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', _TEXT_TYPE(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.rstrip('/')
+            if path == '/metrics':
+                return _reply_metrics(self)
+            body = None
+            with lock:
+                if path == '':
+                    body = dump({
+                        'version': __version__,
+                        'caps': caps,
+                        'workers': workers,
+                        'queued': pending.qsize(),
+                    })
+                elif path == '/jobs':
+                    body = dump([jobs[jid] for jid in order])
+                elif path.startswith('/jobs/') and path[6:] in jobs:
+                    body = dump(jobs[path[6:]])
+            if body is None:
+                return self.reply(404, {'error': 'not found'})
+            self.send(200, body)
+
+        def check_request(self):
+            """
+            Refuse requests which browsers may send cross-site. Simple
+            requests can't have JSON type and scripts always add Origin.
+            """
+            if self.headers.get('Origin') is not None:
+                self.reply(403, {'error': 'cross-origin requests are '
+                                          'not allowed'})
+                return False
+            ctype = (self.headers.get('Content-Type') or '').split(';')[0]
+            if self.command == 'POST' and \
+                    ctype.strip().lower() != 'application/json':
+                self.reply(415, {'error': 'content type must be '
+                                          'application/json'})
+                return False
+            return True
+
+        def do_POST(self):
+            if not self.check_request():
+                return
+            if self.path.rstrip('/') != '/jobs':
+                return self.reply(404, {'error': 'not found'})
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+                entry = json.loads(self.rfile.read(length).decode('utf-8'))
+                job = submit(entry)
+            except Exception as exc:
+                return self.reply(400, {'error': _TEXT_TYPE(exc)})
+            with lock:
+                body = dump(job)
+            self.send(201, body)
+
+        def do_DELETE(self):
+            if not self.check_request():
+                return
+            path = self.path.rstrip('/')
+            job = cancel(path[6:]) if path.startswith('/jobs/') else None
+            if job is None:
+                return self.reply(404, {'error': 'not found'})
+            with lock:
+                body = dump(job)
+            self.send(200, body)
+
+    if isinstance(address, tuple):
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+    else:
+        try:
+            from socketserver import UnixStreamServer
+        except ImportError:
+            from SocketServer import UnixStreamServer
+
+        class Server(ThreadingMixIn, UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(address):
+            os.remove(address)
+
+    server = Server(address, Handler)
+    for _ in _range(workers):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+    print('Serving on {} with {} workers'.format(serveopts.serve, workers),
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if not isinstance(address, tuple):
+            os.remove(address)
+
+
+_SHARED_CAPS = {}
+_SHARED_CAPS_LOCK = threading.Lock()
+
+
+def _get_shared_caps():
+    with _SHARED_CAPS_LOCK:
+        if not _SHARED_CAPS:
+            _SHARED_CAPS.update(get_capabilities([]))
+        return _SHARED_CAPS
+
+
+class Result(object):
+    """
+    Outcome of :meth:`Encoder.run`. ``estimation`` is set instead of
+    ``size`` if ``estimate`` option was given.
+    """
+
+    def __init__(self, options, elapsed):
+        self.options = options
+        self.outfile = options.outfile
+        self.duration = options.outduration
+        self.video_bitrate = options.vb
+        self.audio_bitrate = options.ab
+        self.crf = options.crf
+        self.remuxed = getattr(options, 'remuxed', False)
+        self.cached = getattr(options, 'cached', False)
+        self.time = elapsed
+        self.estimation = getattr(options, 'estimation', None)
+        self.phases = get_phase_report(options)
+        self.size = None
+        if self.estimation is None:
+            self.size = os.path.getsize(options.outfile)
+
+    def __repr__(self):
+        return '<Result {!r}, {} B, {:.1f}s>'.format(
+            self.outfile, self.size, self.time)
+
+
+class Encoder(object):
+    """
+    Encode single file without going through the command line::
+
+        import webm
+        result = webm.Encoder('in.mkv', l=10, av1=True).run()
+        print(result.outfile, result.size)
+
+    Keyword arguments are option names without dashes, same as keys of
+    batch manifest; underscores may be used instead of dashes. Invalid
+    options raise :class:`OptionsError` right away. FFmpeg output is
+    hidden unless ``v`` or ``q=False`` is given. Encoders don't share
+    any state except capabilities, so they may be run from threads;
+    running encode may be stopped from another thread with
+    :meth:`cancel`.
+    """
+
+    def __init__(self, infile, outfile=None, caps=None, **kwargs):
+        self.caps = _get_shared_caps() if caps is None else caps
+        entry = dict((k.replace('_', '-'), v) for k, v in kwargs.items())
+        if not entry.get('v'):
+            entry.setdefault('q', True)
+        entry['i'] = infile
+        entry['outfile'] = outfile
+        parser = _get_parser(self.caps, exit_on_error=False)
+        args = _entry_to_args(parser, entry)
+        self.options = process_options(self.caps, args, exit_on_error=False)
+        if self.options.p:
+            raise OptionsError('interactive mode cannot be used from API')
+        self._token = None
+
+    def run(self):
+        """Run the encode, may be called several times."""
+        options = copy.copy(self.options)
+        options.cancel = self._token = CancelToken()
+        options.stats = _PhaseStats()
+        start = time.time()
+        try:
+            _check_encoders(options, self.caps)
+            encode(options, self.caps)
+        finally:
+            options.stats.start('cleanup')
+            cleanup(options)
+            options.stats.finish()
+        return Result(options, time.time() - start)
+
+    def cancel(self):
+        """
+        Kill FFmpeg processes of the latest :meth:`run`, which then raises
+        :class:`CancelledError`.
+        """
+        if self._token is not None:
+            self._token.cancel()
+
+
 def main():
-    caps = {'pythonv': 'n/a', 'ffmpegv': 'n/a', 'row_mt': False, 'mpvv': 'n/a'}
+    caps = {
+        'pythonv': 'n/a',
+        'ffmpegv': 'n/a',
+        'encoders': [],
+        'row_mt': False,
+        'aom_row_mt': False,
+        'aom_tile_rows': False,
+        'mpvv': 'n/a',
+    }
     options = None
+    stats = _PhaseStats()
+    status = 'failed'
+    error = None
+    failure = None
+    mainstart = time.time()
     try:
+        stats.start('capabilities')
         if '-cn' not in ARGS:
             caps.update(get_capabilities())
         if '-hi' in ARGS or '--help-imode' in ARGS:
             print_interactive_help()
             sys.exit()
+        _start_metrics(ARGS)
+        if '--serve' in ARGS or any(a.startswith('--serve=') for a in ARGS):
+            serve(caps)
+            return
+        if ('--batch' in ARGS or
+                any(a.startswith('--batch=') for a in ARGS) or
+                ARGS.count('-i') > 1):
+            run_batch(caps)
+            return
         options = process_options(caps)
+        options.stats = stats
         if options.p:
+            stats.start('interactive')
             run_interactive_mode(options)
         start = time.time()
         encode(options, caps)
-        print_stats(options, start)
+        stats.finish()
+        status = 'ok'
+        if options.estimate:
+            print(json.dumps(options.estimation, sort_keys=True))
+        else:
+            print_stats(options, start)
     except Exception as exc:
-        if _is_verbose(options):
+        error = _TEXT_TYPE(exc)
+        failure = exc
+        if _is_verbose(options) or (options is None and '-v' in ARGS):
             exc = '\n\n' + traceback.format_exc()[:-1]
         err = 'Cannot proceed due to the following error: {}'.format(exc)
         sys.exit(err)
     finally:
+        stats.start('cleanup')
         cleanup(options)
+        stats.finish()
+        if options is not None and options.stats_json is not None:
+            _write_stats_json(options, status, error)
+        if options is not None:
+            _record_metrics(
+                options, status, time.time() - mainstart, failure)
 
 
 MPV_SCRIPT = br"""